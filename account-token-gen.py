@@ -1,9 +1,17 @@
 # tokens.py
+import re
+import threading
+from collections import OrderedDict
+from time import monotonic
 from django.contrib.auth.tokens import PasswordResetTokenGenerator  
 
 class TokenGenerator(PasswordResetTokenGenerator):
     # used to replacee settings.PASSWORD_RESET_TIMEOUT, set your length of token here. Currently is 7 days
     timeout = 60 * 60 * 24 * 7
+    # Second HMAC with the pre Django 3.1 algorithm for old tokens, set False once those have all expired
+    legacy = True
+    # timestamp-hash, hash is 20 hex chars (sha1) or 32 (sha256)
+    token_re = re.compile(r'^[0-9a-z]{1,13}-[0-9a-f]{20,64}$')
     
     def _make_hash_value(self, user, timestamp):  
         return (  
@@ -11,36 +19,78 @@ class TokenGenerator(PasswordResetTokenGenerator):
             text_type(user.is_active)  
         )
     
+    def parse_timestamp(self, token):
+        """ Timestamp from the token, or None if it's malformed or expired.
+        Doesn't need the user, so junk and old links get turned away before any query or HMAC
+        """
+        if not token or not self.token_re.match(token):
+            return None
+        ts_b36, _ = token.split("-")
+        try:
+            ts = base36_to_int(ts_b36)
+        except ValueError:
+            return None
+        # Tokens made before Django 3.1 count days instead of seconds
+        legacy_token = len(ts_b36) < 4
+        if legacy_token and not self.legacy:
+            return None
+        now = self._now()
+        age_ts = ts
+        if legacy_token:
+            age_ts *= 24 * 60 * 60
+            age_ts += int((now - datetime.combine(now.date(), time.min)).total_seconds())
+        if (self._num_seconds(now) - age_ts) > self.timeout:
+            return None
+        return ts
+
     def check_token(self, user, token):
-        """ Copy + paste from DJango PasswordTokenGenerator to overwrite line 39 for timeout"""
+        """ Copy + paste from DJango PasswordTokenGenerator to overwrite line 39 for timeout,
+        format and expiry are checked first and the legacy HMAC only runs if self.legacy
+        """
         if not (user and token):
             return False
-        try:
-            ts_b36, _ = token.split("-")
-            legacy_token = len(ts_b36) < 4
-        except ValueError:
+        ts = self.parse_timestamp(token)
+        if ts is None:
             return False
+        if constant_time_compare(self._make_token_with_timestamp(user, ts), token):
+            return True
+        return self.legacy and constant_time_compare(
+            self._make_token_with_timestamp(user, ts, legacy=True),
+            token,
+        )
 
-        try:
-            ts = base36_to_int(ts_b36)
-        except ValueError:
-            return False
 
-        if not constant_time_compare(self._make_token_with_timestamp(user, ts), token):
-            if not constant_time_compare(
-                self._make_token_with_timestamp(user, ts, legacy=True),
-                token,
-            ):
+class RecentTokens:
+    """ Remembers tokens that were already used or failed the HMAC check, so link scanners and bots replaying
+    them get turned away without a query. Bounded, oldest are dropped first. Per process, use the cache
+    framework instead if every gunicorn worker should share it. Locked since threaded workers share it
+    """
+
+    def __init__(self, max_size=10000, ttl=TokenGenerator.timeout):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, token):
+        with self.lock:
+            added = self.entries.get(token)
+            if added is None:
                 return False
-        now = self._now()
-        if legacy_token:
-            ts *= 24 * 60 * 60
-            ts += int((now - datetime.combine(now.date(), time.min)).total_seconds())
-        if (self._num_seconds(now) - ts) > self.timeout:
-            return False
-        return True
-        
+            if monotonic() - added > self.ttl:
+                del self.entries[token]
+                return False
+            return True
+
+    def add(self, token):
+        with self.lock:
+            self.entries[token] = monotonic()
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
 account_token = TokenGenerator()
+recent_tokens = RecentTokens()
 
 
 # Seperate file
@@ -60,16 +110,28 @@ from django.utils.encoding import force_bytes, force_text
             )  
           email.send() 
       
+# Checks cheapest first: replays and bad/expired tokens never hit the database
+def verify_activation(uidb64, token):
+    if token in recent_tokens or account_token.parse_timestamp(token) is None:
+        return None
+    try:
+        uid = force_text(urlsafe_base64_decode(uidb64))
+        user = User.objects.get(pk=uid)
+    except(TypeError, ValueError, OverflowError, User.DoesNotExist):
+        # Bad or deleted uid, replaying the link won't find anyone either
+        recent_tokens.add(token)
+        return None
+    valid = account_token.check_token(user, token)
+    # Only remembered once checked, used or failed the same link shouldn't cost another query
+    recent_tokens.add(token)
+    return user if valid else None
+
 # Later on simple function baed view:
 # url pattern would be like: accounts/activate/<str:uidb64>/<str:token>/
 def activate_account(request, uidb64, token):
-    try:  
-        uid = force_text(urlsafe_base64_decode(uidb64))  
-        user = User.objects.get(pk=uid)
-        next_url = request.GET.get('next') or reverse_lazy('user')  
-    except(TypeError, ValueError, OverflowError, User.DoesNotExist):  
-        user = None  
-    if user is not None and account_activation_token.check_token(user, token):
+    user = verify_activation(uidb64, token)
+    next_url = request.GET.get('next') or reverse_lazy('user')  
+    if user is not None:
         # Handle your stuff here such as account activation, such as:
         # user.is_active = True
         # user.save()
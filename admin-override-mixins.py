@@ -1,17 +1,338 @@
+import hashlib
+import logging
+import time
+from collections import Counter
+from django.conf import settings
+from django.contrib.admin.views.autocomplete import AutocompleteJsonView
+from django.contrib.admin.views.main import ChangeList
+from django.core.cache import caches
+from django.core.exceptions import FieldDoesNotExist, PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connection, connections
+from django.db.models.base import ModelBase
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.signals import post_delete, post_save
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
+from django.utils.functional import cached_property
+
+logger = logging.getLogger(__name__)
+
+
 class AutocompleteOverrideMixin:
     """ By default Django's Admin lists all relationship fields as a Select Field.
     This is useful in some cases, but in many could cause problems as it requires pulling all
     records from the database in order to populate the select choices dropdown. In some production sites
     this can lead to many seconds to load a single page in django admin.
     This Mixin sets all relationships in admin where it is used to use autocomplete instead of select for performance reasons
-    It leverages the get_fields() method is called as part of instantiating the admin
+    Covers ForeignKey, OneToOne and ManyToMany fields, worked out once per registered admin the first time a form needs it.
+    Relations to models that aren't registered in the admin with search_fields keep the normal select, autocomplete can't search those
+    """
+
+    def get_autocomplete_fields(self, request):
+        return self._autocomplete_fields
+
+    @cached_property
+    def _autocomplete_fields(self):
+        # On the instance, there's one per model and site. The class can be registered for more than one model
+        return tuple(dict.fromkeys((*self.autocomplete_fields, *self.related_field_names())))
+
+    def related_field_names(self):
+        opts = self.model._meta
+        for field in (*opts.fields, *opts.many_to_many):
+            if not field.is_relation or not field.editable:
+                continue
+            if field.many_to_many and not field.remote_field.through._meta.auto_created:
+                # Custom through tables aren't editable on the form
+                continue
+            related_admin = self.admin_site._registry.get(field.related_model)
+            if related_admin and related_admin.search_fields:
+                yield field.name
+
+
+class PerformanceChangeList(ChangeList):
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        prefetch = self.model_admin.get_list_prefetch_related(request)
+        return qs.prefetch_related(*prefetch) if prefetch else qs
+
+
+class AdminPerformanceMixin(AutocompleteOverrideMixin):
+    """ Autocomplete for relationship fields, plus changelists that don't run a query per row.
+    list_select_related / prefetch_related are worked out from list_display (once per registered admin): foreign keys shown
+    directly, and related paths in admin_order_field of methods like:
+        @admin.display(ordering='event__venue__name')
+        def venue(self, obj):
+            return obj.event.venue.name
+    Paths through a m2m or reverse relation get prefetched instead, add more with list_prefetch_related.
+    Setting list_select_related yourself still wins.
+    Set this module's logger to DEBUG to log each changelist's query count and its most repeated query. The count is also
+    sent back in an X-Admin-Queries header, set query_debug = True to get just that without the logging
+    Sample:
+        class BookingAdmin(AdminPerformanceMixin, admin.ModelAdmin):
+            list_display = ('attendee', 'event', 'venue')
+    """
+    list_prefetch_related = ()
+    query_debug = False
+
+    def get_changelist(self, request, **kwargs):
+        return PerformanceChangeList
+
+    def get_list_select_related(self, request):
+        if self.list_select_related is not False:
+            return self.list_select_related
+        return self.related_paths()[0] or False
+
+    def get_list_prefetch_related(self, request):
+        return (*self.related_paths()[1], *self.list_prefetch_related)
+
+    def related_paths(self):
+        """ (select_related paths, prefetch_related paths) needed by list_display """
+        return self._related_paths
+
+    @cached_property
+    def _related_paths(self):
+        # Per instance like _autocomplete_fields, the paths depend on self.model
+        select, prefetch = {}, {}
+        for name in self.list_display:
+            for path in self.display_paths(name):
+                joins = self.follow(path)
+                if not joins:
+                    continue
+                # Single valued all the way can be joined, anything after a many relation gets prefetched
+                if not any(field.many_to_many or field.one_to_many for field in joins):
+                    select[LOOKUP_SEP.join(f.name for f in joins)] = None
+                else:
+                    prefetch[LOOKUP_SEP.join(f.name for f in joins)] = None
+        # A path already covered by a longer one isn't needed
+        return (
+            [p for p in select if not any(o.startswith(p + LOOKUP_SEP) for o in select)],
+            [p for p in prefetch if not any(o.startswith(p + LOOKUP_SEP) for o in prefetch)],
+        )
+
+    def display_paths(self, name):
+        if callable(name):
+            attr = name
+        else:
+            try:
+                field = self.model._meta.get_field(name)
+                return [field.name] if field.is_relation else []
+            except FieldDoesNotExist:
+                attr = getattr(self, name, None) or getattr(self.model, name, None)
+        ordering = getattr(attr, 'admin_order_field', None)
+        if isinstance(ordering, str):
+            return [ordering.lstrip('-')]
+        return []
+
+    def follow(self, path):
+        """ The relation fields along path, the last part is dropped if it's a plain column """
+        model, joins = self.model, []
+        for part in path.split(LOOKUP_SEP):
+            try:
+                field = model._meta.get_field(part)
+            except FieldDoesNotExist:
+                break
+            if not field.is_relation:
+                break
+            joins.append(field)
+            model = field.related_model
+        return joins
+
+    def changelist_view(self, request, extra_context=None):
+        if not (self.query_debug or logger.isEnabledFor(logging.DEBUG)):
+            return super().changelist_view(request, extra_context)
+        queries = CaptureQueriesContext(connection)
+        queries.__enter__()
+        try:
+            response = super().changelist_view(request, extra_context)
+        except BaseException:
+            queries.__exit__(None, None, None)
+            raise
+
+        def report(response):
+            queries.__exit__(None, None, None)
+            repeated = Counter(query['sql'] for query in queries.captured_queries).most_common(1)
+            logger.debug(
+                '%s changelist: %d queries%s', self.model._meta.label, len(queries),
+                f', ran {repeated[0][1]}x: {repeated[0][0][:200]}' if repeated and repeated[0][1] > 1 else '',
+            )
+            response['X-Admin-Queries'] = str(len(queries))
+
+        # Most queries happen while the template renders, so count after that
+        if hasattr(response, 'add_post_render_callback') and not response.is_rendered:
+            response.add_post_render_callback(report)
+        else:
+            report(response)
+        return response
+
+
+def planner_estimate(model, using):
+    """ Row count the database keeps in its stats for the model's table, no table scan. None if there isn't one """
+    conn = connections[using]
+    table = model._meta.db_table
+    with conn.cursor() as cursor:
+        if conn.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)', [conn.ops.quote_name(table)])
+        elif conn.vendor == 'mysql':
+            cursor.execute(
+                'SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s', [table]
+            )
+        else:
+            return None
+        row = cursor.fetchone()
+    # Postgres has -1 for tables that were never analyzed
+    return row[0] if row and row[0] and row[0] > 0 else None
+
+
+class ApproxCount(int):
+    """ Still a number for the admin's paging maths, but shows as 'about 1234567' in the templates """
+
+    def __new__(cls, value, prefix):
+        count = super().__new__(cls, value)
+        count.prefix = prefix
+        return count
+
+    def __str__(self):
+        return f'{self.prefix} {int(self)}'
+
+
+class EstimatedCountPaginator(Paginator):
+    """ Skips the exact COUNT(*) on big unfiltered tables. Uses the planner's row estimate (Postgres, MySQL),
+    or on other databases counts no further than threshold. Filtered/searched lists and small tables get the exact count
+    """
+    threshold = 10000
+
+    def __init__(self, *args, threshold=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold or self.threshold
+        self.estimated = None
+
+    @cached_property
+    def count(self):
+        qs = self.object_list
+        if not hasattr(qs, 'query') or qs.query.where or qs.query.distinct:
+            return super().count
+        estimate = planner_estimate(qs.model, qs.db)
+        if estimate is not None:
+            if estimate <= self.threshold:
+                return super().count
+            self.estimated = 'about'
+            return estimate
+        capped = qs.order_by()[:self.threshold + 1].count()
+        if capped > self.threshold:
+            self.estimated = 'more than'
+            return self.threshold
+        return capped
+
+
+class EstimatedCountMixin:
+    """ For changelists on the biggest tables (bookings, users, images): no exact COUNT(*) on every load,
+    the count shows as 'about N' instead. The second count of the whole table when filtered is turned off too.
+    Works alongside AdminPerformanceMixin
+    Sample:
+        class BookingAdmin(EstimatedCountMixin, AdminPerformanceMixin, admin.ModelAdmin):
+            estimate_count_above = 50000
     """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    estimate_count_above = EstimatedCountPaginator.threshold
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        return self.paginator(queryset, per_page, orphans, allow_empty_first_page, threshold=self.estimate_count_above)
+
+    def get_changelist_instance(self, request):
+        cl = super().get_changelist_instance(request)
+        if getattr(cl.paginator, 'estimated', None):
+            cl.result_count = ApproxCount(cl.result_count, cl.paginator.estimated)
+        return cl
+
+
+def autocomplete_cache():
+    # Any cache backend works, locmem for tests. Use a shared one (redis, memcached) with more than one process
+    return caches[getattr(settings, 'ADMIN_AUTOCOMPLETE_CACHE', 'default')]
+
+
+def autocomplete_version_key(model):
+    return f'admin-autocomplete:v:{model._meta.label_lower}'
+
+
+def invalidate_autocomplete(sender, **kwargs):
+    """ Bumps the model's version so every cached search for it is skipped from now on """
+    cache, key = autocomplete_cache(), autocomplete_version_key(sender)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Starts from the clock rather than 1, so an evicted version can't bring back old entries
+        cache.set(key, time.time_ns(), None)
+
+
+def watch_autocomplete_model(model):
+    # dispatch_uid keeps it to one receiver per model however many admins point at it
+    uid = f'admin-autocomplete:{model._meta.label_lower}'
+    post_save.connect(invalidate_autocomplete, sender=model, dispatch_uid=uid)
+    post_delete.connect(invalidate_autocomplete, sender=model, dispatch_uid=uid)
+
+
+class CachedAutocompleteJsonView(AutocompleteJsonView):
+    """ Autocomplete results cached per (searched model, field, term, page, user). Staff typing into an autocomplete box
+    sends an icontains search per keystroke, and the same searches come up over and over.
+    Permission checks still run every request, a save or delete of the searched model empties its entries.
+    Only used for fields of admins with the AutocompleteOverrideMixin (Django 3.2+, where autocomplete is one site-wide view)
+    Entries are per user since get_queryset()/get_search_results() can filter by request.user. Set
+    autocomplete_cache_per_user = False on the site to share them between all staff when no admin on it does that
+    """
+    timeout = 60 * 5
+    cache_per_user = True
+
+    def get(self, request, *args, **kwargs):
+        term, model_admin, source_field, to_field_name = self.process_request(request)
+        self.model_admin = model_admin
+        if not self.has_perm(request):
+            raise PermissionDenied
+        source_admin = self.admin_site._registry.get(source_field.model)
+        if not isinstance(source_admin, AutocompleteOverrideMixin):
+            return super().get(request, *args, **kwargs)
+
+        model = model_admin.model
+        watch_autocomplete_model(model)
+        cache = autocomplete_cache()
+        version = cache.get_or_set(autocomplete_version_key(model), time.time_ns(), None)
+        term_hash = hashlib.md5(term.strip().lower().encode()).hexdigest()
+        key = (
+            f'admin-autocomplete:{model._meta.label_lower}:{version}:{source_field.model._meta.label_lower}.'
+            f'{source_field.name}:{to_field_name}:{term_hash}:{request.GET.get(self.page_kwarg, 1)}:'
+            f'{request.user.pk if self.cache_per_user else "all"}'
+        )
+        content = cache.get(key)
+        if content is None:
+            response = super().get(request, *args, **kwargs)
+            cache.set(key, response.content, self.timeout)
+            return response
+        return HttpResponse(content, content_type='application/json')
+
+
+class CachedAutocompleteSiteMixin:
+    """ Serves the admin's autocomplete endpoint from CachedAutocompleteJsonView
+    Sample:
+        class MyAdminSite(CachedAutocompleteSiteMixin, admin.AdminSite):
+            pass
+    and point default_site in an AdminConfig at it to swap out admin.site
+    """
+    autocomplete_cache_per_user = True
+
+    def register(self, model_or_iterable, admin_class=None, **options):
+        models = [model_or_iterable] if isinstance(model_or_iterable, ModelBase) else list(model_or_iterable)
+        super().register(models, admin_class, **options)
+        for model in models:
+            if not isinstance(self._registry.get(model), AutocompleteOverrideMixin):
+                continue
+            # Every process registers its admins at startup, so a save anywhere clears cached autocomplete results.
+            # Only sites that cache connect these, other sites don't pay a cache write per save
+            for field in (*model._meta.fields, *model._meta.many_to_many):
+                if field.is_relation and field.related_model:
+                    watch_autocomplete_model(field.related_model)
 
-    def get_fields(self, request, obj=None):
-        fields = self.model._meta.fields
-        new_fields = []
-        for field in fields:
-            if isinstance(field, (models.ForeignKey, models.ManyToManyField)):
-                new_fields.append(field.name)
-        self.autocomplete_fields = (*self.autocomplete_fields, *new_fields)
-        return super().get_fields(request, obj)
+    def autocomplete_view(self, request):
+        return CachedAutocompleteJsonView.as_view(
+            admin_site=self, cache_per_user=self.autocomplete_cache_per_user
+        )(request)
@@ -0,0 +1,137 @@
+# management/commands/send_activation_emails.py
+# Sends activation links (made with account_token from account-token-gen.py) to lots of users at once,
+# like after a migration where everyone has to set a new password
+import json
+import os
+import smtplib
+import time
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.management.base import BaseCommand
+from django.template.loader import get_template
+from django.utils.encoding import force_bytes
+from django.utils.html import strip_tags
+from django.utils.http import urlsafe_base64_encode
+from core.tokens import account_token
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Emails activation links to users in batches over one SMTP connection"
+    """
+    Users are streamed in pk order, a chunk at a time. The template is loaded once, and every email goes out
+    over the same SMTP connection, opened at the start, instead of connecting per email or per batch.
+    After each batch the last pk sent is written to the checkpoint file, so --resume picks up after it
+    (at most the batch that was going out when it stopped gets sent again).
+    Sample Command: python manage.py send_activation_emails --inactive-only --batch-size 100 --rate 20
+    To try it locally point EMAIL_HOST/EMAIL_PORT at a stand-in server: python -m aiosmtpd -n -l localhost:1025
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--inactive-only', action='store_true', help='Only users that are not active yet')
+        parser.add_argument('--template', default='core/emails/user/user_activation.html')
+        parser.add_argument('--subject', default='Activate your account')
+        parser.add_argument('--domain', help='Domain for the links, default is the current Site')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Users loaded per query')
+        parser.add_argument('--batch-size', type=int, default=100, help='Emails between checkpoints')
+        parser.add_argument('--rate', type=float, default=0, help='Max emails per second, 0 for no limit')
+        parser.add_argument('--checkpoint', default='activation_emails.checkpoint', help='Where progress is kept')
+        parser.add_argument('--resume', action='store_true', help='Start after the last user the checkpoint has')
+        parser.add_argument('--dry-run', action='store_true', help="Render everything but don't send")
+
+
+    def handle(self, *args, **options):
+        # Token hash fields plus what the template shows ({{ user }} is first and last name)
+        users = User.objects.exclude(email='').order_by('pk').only(
+            'pk', 'email', 'first_name', 'last_name', 'is_active', 'password', 'last_login'
+        )
+        if options['inactive_only']:
+            users = users.filter(is_active=False)
+        if options['resume'] and os.path.exists(options['checkpoint']):
+            with open(options['checkpoint']) as f:
+                last_pk = json.load(f)['last_pk']
+            users = users.filter(pk__gt=last_pk)
+            self.stdout.write(f'Resuming after user {last_pk}')
+
+        self.template = get_template(options['template'])
+        self.subject = options['subject']
+        self.domain = options['domain'] or Site.objects.get_current().domain
+        # Same timestamp for every token in the run, they all expire together
+        self.timestamp = account_token._num_seconds(account_token._now())
+        self.connection = None if options['dry_run'] else get_connection()
+        if self.connection:
+            # Opened once here, send_messages() would otherwise connect and disconnect on every call
+            self.connection.open()
+        self.min_interval = options['batch_size'] / options['rate'] if options['rate'] else 0
+
+        sent = failed = 0
+        batch = []
+        start = time.monotonic()
+        for user in users.iterator(chunk_size=options['chunk_size']):
+            batch.append((user, self.make_message(user)))
+            if len(batch) >= options['batch_size']:
+                ok, bad = self.send_batch(batch, options)
+                sent, failed = sent + ok, failed + bad
+                batch = []
+                self.stdout.write(f'Sent {sent}, failed {failed}, {sent / max(time.monotonic() - start, 0.001):.0f}/sec')
+        if batch:
+            ok, bad = self.send_batch(batch, options)
+            sent, failed = sent + ok, failed + bad
+
+        if self.connection:
+            self.connection.close()
+        verb = 'Would send' if options['dry_run'] else 'Sent'
+        self.stdout.write(self.style.SUCCESS(f'All Done! {verb} {sent}, failed {failed}'))
+
+    def make_message(self, user):
+        html = self.template.render({
+            'user': user,
+            'domain': self.domain,
+            'uid': urlsafe_base64_encode(force_bytes(user.pk)),
+            'token': account_token._make_token_with_timestamp(user, self.timestamp),
+        })
+        message = EmailMultiAlternatives(self.subject, strip_tags(html), to=[user.email], connection=self.connection)
+        message.attach_alternative(html, 'text/html')
+        return message
+
+    def send_batch(self, batch, options):
+        batch_start = time.monotonic()
+        messages = [message for _, message in batch]
+        if options['dry_run']:
+            sent, failed = len(messages), 0
+        else:
+            sent, failed = self.send_messages(messages)
+            self.save_checkpoint(options['checkpoint'], batch[-1][0].pk)
+        # Throttle to --rate, most relays start refusing past their limit
+        wait = self.min_interval - (time.monotonic() - batch_start)
+        if wait > 0:
+            time.sleep(wait)
+        return sent, failed
+
+    def send_messages(self, messages):
+        """ One message at a time over the open connection, so when something goes wrong part way
+        only the message it happened on is retried or counted as failed, the earlier ones already went out
+        """
+        sent = failed = 0
+        for message in messages:
+            try:
+                try:
+                    sent += self.connection.send_messages([message])
+                except smtplib.SMTPServerDisconnected:
+                    # Relay dropped the connection (idle timeout, max messages per connection), reconnect and retry it
+                    self.connection.close()
+                    self.connection.open()
+                    sent += self.connection.send_messages([message])
+            except smtplib.SMTPException as e:
+                # Refused recipient and the like, the rest of the batch still goes
+                failed += 1
+                self.stdout.write(self.style.WARNING(f'Failed: {message.to[0]}, {e!r}'))
+        return sent, failed
+
+    def save_checkpoint(self, path, last_pk):
+        with open(path, 'w') as f:
+            json.dump({'last_pk': last_pk}, f)
+            f.flush()
+            os.fsync(f.fileno())
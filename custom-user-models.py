@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Upper
 from django.contrib.auth.models import AbstractUser
 
 
@@ -21,6 +22,10 @@ class User(AbstractUser):
 
     objects = UserManager()
 
+    class Meta:
+        # Case-insensitive email lookups (login, password reset) use this instead of scanning the table
+        indexes = [models.Index(Upper('email'), name='user_email_upper_idx')]
+
     def __str__(self):
         return f'{self.first_name} {self.last_name}'
     
@@ -30,3 +35,122 @@ class UserProfile(models.Model):
 
     def __str__(self):
         return self.user.get_full_name()
+
+
+# Seperate file: backends.py
+# settings.py: AUTHENTICATION_BACKENDS = ['core.backends.CachedEmailBackend']
+# and swap 'django.contrib.auth.middleware.AuthenticationMiddleware' for 'core.backends.CachedUserMiddleware'
+from django.conf import settings
+from django.contrib.auth import HASH_SESSION_KEY, get_user_model
+from django.contrib.auth import _get_user_session_key
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.functions import Upper
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.crypto import constant_time_compare
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
+from .models import User, UserProfile
+
+USER_CACHE_TIMEOUT = 60 * 15
+
+
+def user_cache():
+    # Holds password hashes, so point AUTH_USER_CACHE at a cache that's only for the site
+    return caches[getattr(settings, 'AUTH_USER_CACHE', 'default')]
+
+
+def user_cache_key(user_id):
+    return f'auth-user:{user_id}'
+
+
+class CachedEmailBackend(ModelBackend):
+    """ Logs in by email ignoring case, and loads the logged in user on each request together with their profile
+    from the cache (keyed by pk) instead of two queries. Saving or deleting the User or UserProfile drops the entry.
+    queryset.update() and bulk_update() don't send post_save, so users changed that way stay cached for up to
+    USER_CACHE_TIMEOUT. Use update_users() instead (deactivating in bulk especially), it drops their entries too
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        UserModel = get_user_model()
+        email = username or kwargs.get(UserModel.USERNAME_FIELD)
+        if email is None or password is None:
+            return None
+        # Same expression as the user_email_upper_idx index so it's used
+        users = list(UserModel._default_manager.annotate(email_upper=Upper('email')).filter(
+            email_upper=email.upper()
+        ).select_related('profile')[:2])
+        # Older accounts could have the same email in different case, only an exact match gets in then
+        if len(users) > 1:
+            users = [user for user in users if user.email == email]
+        if len(users) != 1:
+            # Run the hasher anyway so a missing account takes as long as a wrong password
+            UserModel().set_password(password)
+            return None
+        user = users[0]
+        if user.check_password(password) and self.user_can_authenticate(user):
+            return user
+        return None
+
+    def get_user(self, user_id):
+        cache, key = user_cache(), user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            UserModel = get_user_model()
+            user = UserModel._default_manager.select_related('profile').filter(pk=user_id).first()
+            if user is None:
+                return None
+            cache.set(key, user, USER_CACHE_TIMEOUT)
+        return user if self.user_can_authenticate(user) else None
+
+
+def update_users(queryset, **fields):
+    """ queryset.update() that also drops the users from the cache, ex: update_users(User.objects.filter(...), is_active=False) """
+    user_ids = list(queryset.values_list('pk', flat=True))
+    updated = queryset.model._default_manager.filter(pk__in=user_ids).update(**fields)
+    # After commit, or a request in between could cache them again as they were
+    transaction.on_commit(lambda: user_cache().delete_many([user_cache_key(pk) for pk in user_ids]))
+    return updated
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_user(sender, instance, **kwargs):
+    user_cache().delete(user_cache_key(instance.pk))
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def forget_profile_user(sender, instance, **kwargs):
+    user_cache().delete(user_cache_key(instance.user_id))
+
+
+def get_cached_user(request):
+    """ django.contrib.auth.get_user, but always through CachedEmailBackend.get_user, so sessions that were
+    logged in with another backend (ModelBackend from before the switch) get the cached user too
+    """
+    if not hasattr(request, '_cached_user'):
+        user = None
+        try:
+            user_id = _get_user_session_key(request)
+        except KeyError:
+            pass
+        else:
+            user = CachedEmailBackend().get_user(user_id)
+            # Same check as get_user, changing the password logs out other sessions
+            session_hash = request.session.get(HASH_SESSION_KEY)
+            if user and not (session_hash and constant_time_compare(session_hash, user.get_session_auth_hash())):
+                request.session.flush()
+                user = None
+        request._cached_user = user or AnonymousUser()
+    return request._cached_user
+
+
+class CachedUserMiddleware(MiddlewareMixin):
+    """ Drop in for AuthenticationMiddleware, request.user is still only loaded when something uses it """
+
+    def process_request(self, request):
+        request.user = SimpleLazyObject(lambda: get_cached_user(request))
@@ -1,3 +1,9 @@
+import csv
+import json
+from collections import Counter, namedtuple
+from django.db.models.functions import Coalesce
+
+
 class EventAttendee(models.Model):
     '''Created when form filled out at event registration page'''
     email = models.EmailField('Email Address')
@@ -15,7 +21,7 @@ class EventAttendee(models.Model):
     @property
     def get_upcoming_bookings(self):
         return EventBooking.objects.filter(attendee=self, 
-            event__event_date__gte=timezone.now()).order_by('event__event_date')
+            event__event_date__gte=timezone.now()).select_related('event').order_by('event__event_date')
 
 
 class Event(models.Model):
@@ -25,6 +31,11 @@ class Event(models.Model):
     event_date = models.DateTimeField()
     is_live_event = models.BooleanField(default=False) # Meaning not a virtual event
     can_register = models.BooleanField(default=True)
+    # Kept up to date by the booking paths below so pages listing events don't count bookings for each one.
+    # Fill it in after migrating (and fix it up any time) from the bookings table with: python manage.py repair_booking_counts
+    # Not editable, an admin form would write back whatever count it loaded
+    booking_count = models.PositiveIntegerField(default=0, editable=False)
+    capacity = models.PositiveIntegerField(null=True, blank=True, help_text='Leave empty for no limit')
     attendees = models.ManyToManyField(
         EventAttendee, 
         through='EventBooking',
@@ -69,15 +80,98 @@ class Event(models.Model):
             obj.save()
         return
 
+    @staticmethod
+    def sync_event_pages(event_pages=None, dry_run=False):
+        """ make_or_update() and remove_registration() for every EventPage at once, for after content imports or
+        recurrence changes. Pages and Events are loaded in a couple of queries and compared in memory, then
+        written with one bulk_create, one bulk_update and one update closing registration for events whose page
+        can't be registered for anymore. Pass a queryset of EventPages to only sync those.
+        Returns (created, updated, closed)
+        """
+        from website.models import EventPage
+
+        pages = event_pages if event_pages is not None else EventPage.objects.all()
+        # most_recent_occurrence reads the page's occurrences, prefetched instead of a query per page
+        # Only published pages, drafts and unpublished ones aren't open for registration
+        pages = pages.live().filter(can_register=True).prefetch_related('occurrences')
+        events = Event.objects.filter(event_page__isnull=False)
+        if event_pages is not None:
+            events = events.filter(event_page__in=event_pages)
+        existing = {event.event_page_id: event for event in events}
+
+        new_events, changed, fields = [], [], set()
+        for event_page in pages:
+            try:
+                e_date = event_page.most_recent_occurrence[0]
+            except TypeError:
+                continue
+            wanted = {
+                'event_name': event_page.title,
+                'event_date': e_date,
+                'is_live_event': event_page.is_live_event,
+                'can_register': True,
+            }
+            obj = existing.get(event_page.pk)
+            if obj is None:
+                new_events.append(Event(event_page=event_page, **wanted))
+                continue
+            updated_fields = [field for field, value in wanted.items() if getattr(obj, field) != value]
+            for field in updated_fields:
+                setattr(obj, field, wanted[field])
+            if updated_fields:
+                changed.append(obj)
+                fields.update(updated_fields)
+
+        # Still open but the page is gone, unpublished, taken off registration or not in the synced pages' set
+        to_close = Event.objects.filter(can_register=True).exclude(event_page__in=pages.values('pk'))
+        if event_pages is not None:
+            to_close = to_close.filter(event_page__in=event_pages)
+        if dry_run:
+            return len(new_events), len(changed), to_close.count()
+        with transaction.atomic():
+            Event.objects.bulk_create(new_events, batch_size=500)
+            if changed:
+                Event.objects.bulk_update(changed, sorted(fields), batch_size=500)
+            closed = to_close.update(can_register=False)
+        return len(new_events), len(changed), closed
+
     #Removes event from event reg form
     @staticmethod
     def remove_registration(event_page):
         event = Event.objects.get(event_page=event_page)
         event.can_register = False
-        event.save()
+        # Only this field, a full save() would overwrite booking_count with the one loaded above
+        event.save(update_fields=['can_register'])
         return
             
 
+    @property
+    def is_full(self):
+        return self.capacity is not None and self.booking_count >= self.capacity
+
+    @property
+    def spots_left(self):
+        return None if self.capacity is None else max(self.capacity - self.booking_count, 0)
+
+    @staticmethod
+    def add_to_count(event_id, n):
+        """ Adds n to the event's booking_count if it has room for n more, checked in the same UPDATE
+        (the row lock makes simultaneous bookings wait their turn). Returns False if it's full or doesn't exist
+        """
+        return bool(Event.objects.filter(
+            models.Q(capacity__isnull=True) | models.Q(capacity__gte=models.F('booking_count') + n), pk=event_id,
+        ).update(booking_count=models.F('booking_count') + n))
+
+    @staticmethod
+    def repair_counts():
+        """ Recounts booking_count from the bookings table for events where it's off, returns how many were """
+        actual = Coalesce(models.Subquery(
+            EventBooking.objects.filter(event=models.OuterRef('pk')).order_by().values('event')
+            .annotate(n=models.Count('pk')).values('n')
+        ), 0)
+        wrong = Event.objects.annotate(actual=actual).exclude(booking_count=models.F('actual'))
+        return Event.objects.filter(pk__in=list(wrong.values_list('pk', flat=True))).update(booking_count=actual)
+
     @property
     def get_date(self):
         return self.event_date.strftime('%a, %B %d, %Y')
@@ -95,11 +189,209 @@ class EventBooking(models.Model):
     def __str__(self):
         return f'{self.event.event_name}: {self.attendee}'
 
+    class Meta:
+        # Duplicate bookings are stopped by the database, so two form submissions at once can't both get in.
+        # Clear out any that already exist with EventBooking.remove_duplicates() before migrating this in
+        constraints = [
+            models.UniqueConstraint(fields=['event', 'attendee'], name='unique_event_attendee_booking'),
+        ]
+
     @staticmethod
     def add_bookings(attendee, checked_events):
         # Ensures no duplicate attendee-eventbookings
-        prev_bookings = [e.id for e in attendee.event_set.all()]
-        new_bookings = [EventBooking(event=e, 
-                        attendee=attendee) for e in checked_events.exclude(id__in=prev_bookings)]
-        Event.attendees.through.objects.bulk_create(new_bookings)
-        return
+        return EventBooking.book_many([(attendee, checked_events)])
+
+    @staticmethod
+    def book_many(registrations, batch_size=1000):
+        """ Books lots of (attendee, events) pairs at once, like a csv of registrations or a popular event opening.
+        Attendees and events can be objects or ids. The events' rows are locked first (in pk order), so calls booking
+        the same events, like a form submitted twice, run one after the other instead of racing. Then one SELECT for
+        pairs already booked, one UPDATE per event adding its new bookings to booking_count, which also checks
+        capacity, and one INSERT for the new pairs (no loading everyone's event_set first).
+        Returns a BookingResult(attendee_id, event_id, created, full, missing) per pair, in the order given,
+        missing is for event ids that don't exist
+        """
+        pairs = {}
+        for attendee, events in registrations:
+            attendee_id = getattr(attendee, 'pk', attendee)
+            for event in events:
+                pairs[(attendee_id, getattr(event, 'pk', event))] = None
+        if not pairs:
+            return []
+
+        attendee_ids, event_ids = {a for a, _ in pairs}, {e for _, e in pairs}
+        with transaction.atomic():
+            # Always in pk order, so two calls booking the same events can't each hold a row lock the other wants.
+            # Nothing else books these events until this commits, so what's read below stays true
+            found = set(Event.objects.select_for_update().filter(pk__in=event_ids).order_by('pk').values_list('pk', flat=True))
+            missing = event_ids - found
+            already = set(EventBooking.objects.filter(
+                attendee_id__in=attendee_ids, event_id__in=found
+            ).values_list('attendee_id', 'event_id'))
+            new_pairs = [(a, e) for a, e in pairs if e in found and (a, e) not in already]
+            # Seats are taken before inserting, an event without room for all its new bookings gets none of them
+            new_per_event = Counter(e for a, e in new_pairs)
+            full = {e for e in sorted(new_per_event) if not Event.add_to_count(e, new_per_event[e])}
+            created = {(a, e) for a, e in new_pairs if e not in full}
+            EventBooking.objects.bulk_create(
+                [EventBooking(attendee_id=a, event_id=e) for a, e in new_pairs if (a, e) in created],
+                batch_size=batch_size,
+            )
+        return [
+            BookingResult(a, e, (a, e) in created, e in full and (a, e) not in already, e in missing) for a, e in pairs
+        ]
+
+    @staticmethod
+    def remove_duplicates():
+        """ Keeps the first booking of each event/attendee pair and deletes the rest """
+        first_ids = EventBooking.objects.values('event', 'attendee').annotate(first_id=models.Min('id')).values_list('first_id', flat=True)
+        return EventBooking.objects.exclude(event=None).exclude(id__in=list(first_ids)).delete()
+
+
+BookingResult = namedtuple('BookingResult', ['attendee_id', 'event_id', 'created', 'full', 'missing'])
+
+
+# Bookings made one at a time (EventBooking.objects.create, admin) and deletes keep the count right too,
+# book_many does its own counting since bulk_create doesn't send signals
+@receiver(post_save, sender=EventBooking)
+def count_booking(sender, instance, created, raw=False, **kwargs):
+    if created and instance.event_id and not raw:
+        Event.objects.filter(pk=instance.event_id).update(booking_count=models.F('booking_count') + 1)
+
+
+@receiver(post_delete, sender=EventBooking)
+def uncount_booking(sender, instance, **kwargs):
+    if instance.event_id:
+        Event.objects.filter(pk=instance.event_id, booking_count__gt=0).update(booking_count=models.F('booking_count') - 1)
+
+
+# Seperate file: management/commands/sync_events.py
+class Command(BaseCommand):
+    help = "Brings Events in line with their EventPages in one pass, run after imports or recurrence changes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would change")
+
+    def handle(self, *args, **options):
+        created, updated, closed = Event.sync_event_pages(dry_run=options['dry_run'])
+        verb = 'Would have' if options['dry_run'] else 'All Done!'
+        self.stdout.write(self.style.SUCCESS(f'{verb} created {created}, updated {updated}, closed registration for {closed} events'))
+
+
+# Seperate file: exports.py
+# Rosters and booking histories written out a row at a time. Rows come straight off the through table as tuples
+# (the joined event/attendee columns in the same query, no model instances and no query per booking) through a
+# server-side cursor on Postgres, so memory stays flat however many bookings an event has
+BOOKING_COLUMNS = [
+    ('event', 'event__event_name'),
+    ('event_date', 'event__event_date'),
+    ('first_name', 'attendee__first_name'),
+    ('last_name', 'attendee__last_name'),
+    ('email', 'attendee__email'),
+    ('time_registered', 'time_registered'),
+]
+
+
+def roster_bookings(event):
+    return EventBooking.objects.filter(event=event).order_by('attendee__last_name', 'attendee__first_name', 'pk')
+
+
+def attendee_bookings(email):
+    # Everyone who signed up with this email, the form makes a new EventAttendee each time
+    return EventBooking.objects.filter(attendee__email__iexact=email).order_by('event__event_date', 'pk')
+
+
+def booking_rows(bookings, chunk_size=2000):
+    return bookings.values_list(*[lookup for _, lookup in BOOKING_COLUMNS]).iterator(chunk_size=chunk_size)
+
+
+class Echo:
+    """ csv.writer hands back each line instead of writing it somewhere """
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, rows_per_chunk=500):
+    writer = csv.writer(Echo())
+    chunk = [writer.writerow([name for name, _ in BOOKING_COLUMNS])]
+    for row in rows:
+        chunk.append(writer.writerow(row))
+        if len(chunk) >= rows_per_chunk:
+            yield ''.join(chunk)
+            chunk = []
+    yield ''.join(chunk)
+
+
+def json_lines(rows, rows_per_chunk=500):
+    names = [name for name, _ in BOOKING_COLUMNS]
+    chunk, sep = ['['], '\n'
+    for row in rows:
+        chunk.append(sep + json.dumps(dict(zip(names, row)), cls=DjangoJSONEncoder))
+        sep = ',\n'
+        if len(chunk) >= rows_per_chunk:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append('\n]\n')
+    yield ''.join(chunk)
+
+
+def export_response(bookings, file_name, fmt='csv'):
+    lines = json_lines if fmt == 'json' else csv_lines
+    response = StreamingHttpResponse(
+        lines(booking_rows(bookings)), content_type='application/json' if fmt == 'json' else 'text/csv'
+    )
+    response['Content-Disposition'] = f'attachment; filename="{file_name}.{fmt}"'
+    return response
+
+
+# url patterns like: events/<int:event_id>/roster.<str:fmt> and bookings/export.<str:fmt>?email=
+@staff_member_required
+def event_roster_export(request, event_id, fmt='csv'):
+    event = get_object_or_404(Event, pk=event_id)
+    return export_response(roster_bookings(event), f'roster-{slugify(event.event_name)}', fmt)
+
+
+@staff_member_required
+def attendee_bookings_export(request, fmt='csv'):
+    email = request.GET.get('email', '')
+    return export_response(attendee_bookings(email), f'bookings-{slugify(email)}', fmt)
+
+
+# Seperate file: management/commands/export_bookings.py
+class Command(BaseCommand):
+    help = "Writes an event's roster or an attendee's booking history as csv or json"
+    """
+    Sample Command: python manage.py export_bookings --event 12 --format csv -o roster.csv
+    Or: python manage.py export_bookings --email someone@example.com --format json
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', type=int, help='Event id for a roster')
+        parser.add_argument('--email', help="Attendee email for their booking history")
+        parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+        parser.add_argument('-o', '--output', help='File to write, default is stdout')
+
+    def handle(self, *args, **options):
+        if options['event']:
+            bookings = roster_bookings(options['event'])
+        elif options['email']:
+            bookings = attendee_bookings(options['email'])
+        else:
+            raise CommandError('Plz give an --event or --email')
+        lines = json_lines if options['format'] == 'json' else csv_lines
+        if options['output']:
+            with open(options['output'], 'w', newline='') as out:
+                for chunk in lines(booking_rows(bookings)):
+                    out.write(chunk)
+        else:
+            for chunk in lines(booking_rows(bookings)):
+                self.stdout.write(chunk, ending='')
+
+
+# Seperate file: management/commands/repair_booking_counts.py
+class Command(BaseCommand):
+    help = "Recounts each Event's booking_count from its bookings"
+
+    def handle(self, *args, **options):
+        fixed = Event.repair_counts()
+        self.stdout.write(self.style.SUCCESS(f'All Done! Fixed the count on {fixed} events'))
@@ -0,0 +1,80 @@
+""" Local stand-in for the old site's file server so imports can be benchmarked without the network.
+Any path ending in .pdf gets a pdf, anything else a png (under whatever name was asked for). Content is
+worked out from the path, so the same url is always the same file and different urls are different files.
+python asset_server.py --port 8765 --latency 0.05 --image-size 200 --pdf-kb 500
+"""
+import argparse
+import hashlib
+import struct
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_png(seed, size):
+    """ Valid size x size png, colour from the seed so every url has its own hash """
+    r, g, b = seed[0], seed[1], seed[2]
+    row = b'\x00' + bytes((r, g, b)) * size
+    raw = zlib.compress(row * size, 1)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', raw) + chunk(b'IEND', b'')
+
+
+def make_pdf(seed, kb):
+    body = b'%PDF-1.4\n1 0 obj << /Type /Catalog >> endobj\n% ' + seed.hex().encode() + b'\n'
+    padding = (seed.hex().encode() * (kb * 1024 // 40 + 1))[:max(0, kb * 1024 - len(body))]
+    return body + b'%' + padding + b'\n%%EOF\n'
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real site
+    latency = 0
+    image_size = 200
+    pdf_kb = 200
+    missing = ()
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if any(part in self.path for part in self.missing):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        seed = hashlib.sha1(self.path.encode()).digest()
+        if self.path.endswith('.pdf'):
+            payload, content_type = make_pdf(seed, self.pdf_kb), 'application/pdf'
+        else:
+            payload, content_type = make_png(seed, self.image_size), 'image/png'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=8765, latency=0.0, image_size=200, pdf_kb=200, missing=()):
+    handler = type('ConfiguredHandler', (Handler,), {
+        'latency': latency, 'image_size': image_size, 'pdf_kb': pdf_kb, 'missing': tuple(missing),
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds before each response')
+    parser.add_argument('--image-size', type=int, default=200, help='Width/height of the pngs')
+    parser.add_argument('--pdf-kb', type=int, default=200)
+    parser.add_argument('--missing', action='append', default=[], help='Paths containing this 404')
+    args = parser.parse_args()
+    print(f'Serving assets on http://127.0.0.1:{args.port} with {args.latency}s latency')
+    serve(args.port, args.latency, args.image_size, args.pdf_kb, args.missing).serve_forever()
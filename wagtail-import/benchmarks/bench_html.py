@@ -0,0 +1,90 @@
+""" Bodies/sec for the old BeautifulSoup(html5lib) functions vs the single pass HtmlPipeline.
+Only needs bs4 (+ html5lib for the old functions, lxml optional), no django.
+python bench_html.py --bodies 500 --images 5
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from html_pipeline import ExtractText, HtmlPipeline, RemoveDownloadLink, RewriteImages, StripTags  # noqa: E402
+
+
+def new_url(src):
+    return '/media/original_images/' + src.split('/')[-1]
+
+
+# The functions as they were in import_pages.py / strip_html_papers.py, minus the downloads
+def old_remove_old_download_btn(body):
+    soup = BeautifulSoup(body, features="html5lib")
+    for elem in soup.find_all('a'):
+        if 'ownload' or 'DOWNLOAD' in elem.get_text():
+            elem.decompose()
+            break
+    return str(soup)
+
+
+def old_replace_body_images(body):
+    soup = BeautifulSoup(body, features="html5lib")
+    for elem in soup.find_all('img'):
+        elem['src'] = new_url(elem['src'])
+        elem['class'] = elem.get('class', []) + ['imported-sr-img']
+    return str(soup)
+
+
+def old_strip_html(body):
+    soup = BeautifulSoup(body, "html.parser")
+    for data in soup(['style', 'script']):
+        data.decompose()
+    return ' '.join(soup.stripped_strings)
+
+
+def old_report(body):
+    html = old_replace_body_images(old_remove_old_download_btn(body))
+    return html, old_strip_html(html)
+
+
+pipeline = HtmlPipeline(RemoveDownloadLink(), RewriteImages(new_url, 'imported-sr-img'), StripTags(), ExtractText())
+
+
+def new_report(body):
+    doc = pipeline.run(body)
+    return doc.html, doc.text
+
+
+def make_body(paragraphs, images):
+    parts = ['<p><a href="/files/report.pdf">Download the report</a></p>']
+    for i in range(paragraphs):
+        parts.append(f'<p>Paragraph {i} with <strong>some</strong> <a href="/node/{i}">links</a> and text. ' * 3 + '</p>')
+        if i % max(1, paragraphs // max(1, images)) == 0 and images:
+            parts.append(f'<img src="https://oldsite.com/sites/default/files/img_{random.randint(0, 10 ** 6)}.jpg">')
+    parts.append('<script>var tracking = 1;</script><style>p { color: red; }</style>')
+    return '\n'.join(parts)
+
+
+def bench(name, fn, bodies):
+    start = time.perf_counter()
+    for body in bodies:
+        fn(body)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<40} {len(bodies) / elapsed:>10.1f} bodies/sec')
+    return elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bodies', type=int, default=300)
+    parser.add_argument('--paragraphs', type=int, default=40)
+    parser.add_argument('--images', type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(1)
+    bodies = [make_body(args.paragraphs, args.images) for _ in range(args.bodies)]
+    print(f'{args.bodies} bodies, ~{sum(map(len, bodies)) // len(bodies)} chars each, pipeline parser: {pipeline.parser}')
+    old = bench('old (download btn + images + strip)', old_report, bodies)
+    new = bench('HtmlPipeline single pass', new_report, bodies)
+    print(f'{old / new:.1f}x faster')
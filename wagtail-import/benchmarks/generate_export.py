@@ -0,0 +1,125 @@
+""" Makes a synthetic export shaped like the Drupal 7 one the import commands read.
+python generate_export.py articles.json --kind articles --pages 2000 --images 4 --body-size 8000 --duplicates 0.3
+python generate_export.py users.json --kind users --users 50000
+--asset-url should point at asset_server.py. --duplicates is the share of <img>s that reuse an image
+already used elsewhere in the export (same logo in every body)
+"""
+import argparse
+import json
+import random
+
+WORDS = ('health care policy report national state program people work study local funding data the of and to in').split()
+
+
+def paragraph(rng, size):
+    text = []
+    while sum(map(len, text)) < size:
+        sentence = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 18)))
+        text.append(sentence.capitalize() + '. ')
+    return ''.join(text)
+
+
+def make_body(rng, size, images, image_url, with_download_btn=False):
+    parts = []
+    if with_download_btn:
+        parts.append('<p><a class="btn" href="/files/report.pdf">Download the report</a></p>')
+    per_paragraph = 600
+    count = max(1, size // per_paragraph)
+    img_every = max(1, count // images) if images else None
+    for i in range(count):
+        parts.append(f'<p>{paragraph(rng, per_paragraph)}<a href="/node/{rng.randint(1, 9999)}">more</a></p>')
+        if img_every and i % img_every == 0 and sum('<img' in p for p in parts) < images:
+            parts.append(f'<p><img src="{image_url()}" alt=""></p>')
+    return '\n'.join(parts)
+
+
+class ImageUrls:
+    """ Mix of new images and ones already used, to exercise the asset dedup cache """
+
+    def __init__(self, rng, base, duplicates, ext='jpg'):
+        self.rng, self.base, self.duplicates, self.ext = rng, base, duplicates, ext
+        self.used = []
+
+    def __call__(self):
+        if self.used and self.rng.random() < self.duplicates:
+            return self.rng.choice(self.used)
+        url = f'{self.base}/sites/default/files/field/image/img-{len(self.used)}.{self.ext}'
+        self.used.append(url)
+        return url
+
+
+def make_page(rng, i, kind, args, image_url):
+    content = {
+        'title': f'Synthetic {kind} {i}',
+        'category': rng.choice(['Ideas', 'News', 'Research']),
+        'cover_image': {'src': image_url(), 'alt': '', 'title': ''},
+        'date_display': f'20{rng.randint(10, 22)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+        'author_display': 'Author',
+        'body': make_body(rng, args.body_size, args.images, image_url, with_download_btn=kind == 'Paper'),
+        'tags': ', '.join(rng.sample(['Health Care', 'Policy', 'Data', 'Education', 'Budget'], rng.randint(0, 3))),
+        'app_label': 'website',
+        'caption': None,
+        'youtube_link': None,
+        'slug': f'/article/synthetic-{kind.lower()}-{i}',
+    }
+    if kind in ('Paper', 'Report'):
+        content['slug'] = f'/paper/synthetic-{kind.lower()}-{i}'
+        content['paper'] = f'{args.asset_url}/sites/default/files/papers/paper-{i}.pdf'
+        content['report_html'] = make_body(rng, args.body_size, args.images, image_url) if kind == 'Report' else None
+    if kind == 'Podcast':
+        content['slug'] = f'/content/synthetic-podcast-{i}'
+        content['podcast_url'] = f'https://podcasts.example.com/episodes/{i}'
+    if kind == 'GatedMedia':
+        content['slug'] = f'/media/synthetic-gatedmedia-{i}'
+        content['youtube_link'] = f'https://www.youtube.com/watch?v=synthetic{i}'
+    return {'content': content}
+
+
+def make_user(rng, i):
+    return {'user': {
+        'email': f'user{i}@example.com',
+        'first_name': f'First{i}',
+        'last_name': f'Last{i}',
+        'org_name': 'Org',
+        'is_private_org': rng.choice(['Private', 'Public']),
+        'job_title': 'Job',
+        'address': f'{i} Main St',
+        'city': 'City',
+        'state': 'ST',
+        'zip_code': '00000',
+        'phone': '555-0100',
+    }}
+
+
+def write(path, key, records):
+    with open(path, 'w') as f:
+        if path.endswith(('.ndjson', '.jsonl')):
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            return
+        # Written a record at a time so huge exports can be made too
+        f.write(f'{{"{key}": [')
+        for n, record in enumerate(records):
+            f.write((',\n' if n else '\n') + json.dumps(record))
+        f.write('\n]}\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='.json or .ndjson file to write')
+    parser.add_argument('--kind', default='articles', choices=['articles', 'Paper', 'Report', 'GatedMedia', 'Podcast', 'users'])
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--images', type=int, default=3, help='<img>s per body')
+    parser.add_argument('--body-size', type=int, default=6000, help='Approx characters per body')
+    parser.add_argument('--duplicates', type=float, default=0.3, help='Share of images reused from earlier records')
+    parser.add_argument('--asset-url', default='http://127.0.0.1:8765')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.kind == 'users':
+        write(args.path, 'users', (make_user(rng, i) for i in range(args.users)))
+    else:
+        image_url = ImageUrls(rng, args.asset_url, args.duplicates)
+        write(args.path, 'pages', (make_page(rng, i, args.kind, args, image_url) for i in range(args.pages)))
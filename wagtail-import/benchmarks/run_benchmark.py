@@ -0,0 +1,196 @@
+""" Runs the import commands against synthetic exports and a local asset server, on a throwaway database.
+Run from the site's project dir so django can be set up (the test database settings are used, so it's
+created and dropped like a test run, sqlite gets a temp file so each scenario can run in its own process):
+DJANGO_SETTINGS_MODULE=mysite.settings python path/to/benchmarks/run_benchmark.py --pages 500 --latency 0.05
+Reports records/sec, wall time per stage, db queries, MB downloaded and peak RSS for each scenario.
+Add --json results.json to keep the numbers for comparing runs
+"""
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.getcwd())
+
+import django  # noqa: E402
+
+from asset_server import serve  # noqa: E402
+import generate_export  # noqa: E402
+
+SCENARIOS = {
+    'articles': ('import_articles', 'articles', ['-t', 'Benchmark Articles']),
+    'articles-bulk': ('import_articles', 'articles', ['-t', 'Benchmark Articles', '--bulk']),
+    'articles-workers': ('import_articles', 'articles', ['-t', 'Benchmark Articles', '--bulk', '--workers', '4']),
+    'papers': ('import_pages', 'Paper', ['-t', 'Paper']),
+    'papers-bulk': ('import_pages', 'Paper', ['-t', 'Paper', '--bulk']),
+    'users': ('import_users', 'users', []),
+    'users-batched': ('import_users', 'users', ['--batched']),
+}
+
+def make_fixtures():
+    """ Index pages and collections the commands look up """
+    from wagtail.core.models import Collection, Site
+    from website.models import ArticleIndexPage, PaperIndexPage
+
+    root_collection = Collection.get_first_root_node()
+    for name in ('prev img', 'Papers', 'Reports'):
+        if not Collection.objects.filter(name=name).exists():
+            root_collection.add_child(name=name)
+    home = Site.objects.get(is_default_site=True).root_page
+    if not ArticleIndexPage.objects.filter(title='Benchmark Articles').exists():
+        home.add_child(instance=ArticleIndexPage(title='Benchmark Articles', slug='benchmark-articles'))
+    for title in ('Papers', 'Reports'):
+        if not PaperIndexPage.objects.filter(title=title).exists():
+            home.add_child(instance=PaperIndexPage(title=title, slug=f'benchmark-{title.lower()}'))
+
+
+def run_scenario(name, export, asset_cache):
+    """ Stage times, query counts and bytes downloaded come from the command's own --metrics-json """
+    from django.core.management import call_command
+
+    command_name, _, args = SCENARIOS[name]
+    metrics_path = export + '.metrics.json'
+    args = args + ['--metrics-json', metrics_path]
+    if command_name != 'import_users':
+        args = args + ['--asset-cache', asset_cache, '--journal', export + '.journal', '--retry-file', export + '.retry']
+    start = time.perf_counter()
+    call_command(command_name, export, *args, stdout=io.StringIO())
+    wall = time.perf_counter() - start
+    with open(metrics_path) as f:
+        metrics = json.load(f)
+    return {
+        'wall': wall,
+        'queries': metrics['queries'],
+        'max_queries_per_record': metrics['queries_per_record']['max'],
+        'bytes_downloaded': metrics['bytes_downloaded'],
+        'stages': {stage: data['seconds'] for stage, data in metrics['stages'].items()},
+    }
+
+
+def run_isolated(fn, *args):
+    """ Forks so each scenario gets its own peak RSS (from wait4) and nothing leaks between them """
+    from django.db import connections
+
+    connections.close_all()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            result = {'ok': True, **fn(*args)}
+        except Exception as e:
+            result = {'ok': False, 'error': repr(e)}
+        with os.fdopen(write_fd, 'w') as out:
+            json.dump(result, out)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = json.loads(f.read() or '{"ok": false, "error": "no result"}')
+    _, _, usage = os.wait4(pid, 0)
+    result['peak_rss_mb'] = usage.ru_maxrss / 1024
+    return result
+
+
+def print_report(results):
+    stages = sorted({stage for r in results.values() for stage in r.get('stages', {})})
+    header = f"{'scenario':<18}{'records':>8}{'rec/s':>9}{'wall s':>9}{'queries':>9}{'q/rec':>7}{'max q':>7}{'MB dl':>8}{'RSS MB':>8}"
+    print(header + ''.join(f'{stage:>13}' for stage in stages))
+    for name, r in results.items():
+        if not r['ok']:
+            print(f"{name:<18} failed: {r['error']}")
+            continue
+        line = (
+            f"{name:<18}{r['records']:>8}{r['records'] / r['wall']:>9.1f}{r['wall']:>9.2f}"
+            f"{r['queries']:>9}{r['queries'] / max(r['records'], 1):>7.1f}{r['max_queries_per_record']:>7}"
+            f"{r['bytes_downloaded'] / 1024 / 1024:>8.1f}{r['peak_rss_mb']:>8.0f}"
+        )
+        print(line + ''.join(f"{r['stages'].get(stage, 0):>13.2f}" for stage in stages))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--images', type=int, default=3)
+    parser.add_argument('--body-size', type=int, default=6000)
+    parser.add_argument('--duplicates', type=float, default=0.3)
+    parser.add_argument('--latency', type=float, default=0.05, help='Asset server delay per request')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--keep-db', action='store_true', help="Don't drop the test database at the end")
+    parser.add_argument('--json', help='Also write the results here')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='import-bench-')
+    from django.conf import settings
+    # Images and pdfs the imports save go in the temp dir too, not the site's media
+    settings.MEDIA_ROOT = os.path.join(tmp, 'media')
+    default = getattr(settings, 'STORAGES', {}).get('default', {})
+    if 'location' in default.get('OPTIONS', {}):
+        default['OPTIONS']['location'] = settings.MEDIA_ROOT
+    django.setup()
+    from django.test.utils import setup_databases, teardown_test_environment, setup_test_environment
+
+    db = settings.DATABASES['default']
+    if db['ENGINE'].endswith('sqlite3'):
+        # In memory test db can't be shared with the forked scenarios
+        db.setdefault('TEST', {})['NAME'] = os.path.join(tmp, 'bench.sqlite3')
+
+    server = serve(args.port, args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    setup_test_environment()
+    old_config = setup_databases(verbosity=0, interactive=False, keepdb=args.keep_db)
+    make_fixtures()
+
+    results = {}
+    try:
+        for name in args.scenarios:
+            _, kind, _ = SCENARIOS[name]
+            export = os.path.join(tmp, f'{name}.json')
+            gen_args = argparse.Namespace(
+                images=args.images, body_size=args.body_size, asset_url=f'http://127.0.0.1:{args.port}'
+            )
+            rng = random.Random(name)
+            if kind == 'users':
+                records = args.users
+                # Different emails per scenario, otherwise the second one only finds existing users
+                offset = len(results) * 10 ** 7
+                generate_export.write(export, 'users', (
+                    generate_export.make_user(rng, offset + i) for i in range(records)
+                ))
+            else:
+                records = args.pages
+                image_url = generate_export.ImageUrls(rng, gen_args.asset_url + '/' + name, args.duplicates)
+                generate_export.write(export, 'pages', (
+                    generate_export.make_page(rng, i, kind if kind != 'articles' else 'Article', gen_args, image_url)
+                    for i in range(records)
+                ))
+            print(f'Running {name}...')
+            result = run_isolated(run_scenario, name, export, os.path.join(tmp, f'{name}.assets.sqlite3'))
+            result['records'] = records
+            results[name] = result
+    finally:
+        server.shutdown()
+        if not args.keep_db:
+            from django.test.utils import teardown_databases
+            teardown_databases(old_config, verbosity=0)
+            # The sqlite test db is in here too, so it stays with --keep-db
+            shutil.rmtree(tmp, ignore_errors=True)
+        teardown_test_environment()
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,6 @@
 import json
-import urllib.request
-import uuid
 from datetime import datetime
-from bs4 import BeautifulSoup
-from django.core.files.uploadedfile import SimpleUploadedFile
-from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
-from django.core.validators import validate_slug
-from django.core import exceptions
-from django.utils.text import slugify
+from django.core.management.base import CommandError
 from django.utils.timezone import make_aware
 from wagtail.core.models import Collection
 from wagtail.images.models import Image
@@ -21,9 +13,14 @@ from website.models import (
     PodcastIndexPage,
     PodcastPage
 )
+from ..utils.html_pipeline import HtmlPipeline, RemoveDownloadLink, RewriteImages
+from ..utils.import_command import ImportCommand
+from ..utils.metrics import stage
+from ..utils.parallel import PrepareJob
+from ..utils.reference_cache import references
 
 
-class Command(BaseCommand):
+class Command(ImportCommand):
     help = "Imports from old drupal 7 site via json format"
     """
     Need to have created desired index pages before running this.
@@ -51,170 +48,138 @@ class Command(BaseCommand):
         },
     ]
     """
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.img_collection = Collection.objects.get(name='prev img')
-        self.paper_collection = None
+    asset_label = 'images/pdfs'
 
     def add_arguments(self, parser):
         parser.add_argument('the_file', help='the file to import')
         parser.add_argument('-t', '--type', type=str, help='Page Type, Paper, Podcast, GatedMedia, etc.', )
+        super().add_arguments(parser)
 
-
-    def handle(self, *args, **options):
-        
+    def setup(self, options):
         if not options['type']:
             raise CommandError('Plz specify page type, ex: -t Podcast')
         
-        try:
-            page_types = {
-                'GatedMedia': [GatedMediaIndexPage.objects.first(), GatedMediaPage],
-                'Paper': [PaperIndexPage.objects.get(title='Papers'), PaperPage],
-                'Report': [PaperIndexPage.objects.get(title='Reports'), PaperPage],
-                'Podcast': [PodcastIndexPage.objects.first(), PodcastPage],
-            }
-            # Should only be one type of each index page
-            parent = page_types[options['type']][0]
-            page_type = page_types[options['type']][1]
-        except Exception:
+        # Reference data comes from the shared identity map, loaded once instead of queried per page
+        page_types = {
+            'GatedMedia': [references.first(GatedMediaIndexPage), GatedMediaPage],
+            'Paper': [references.get(PaperIndexPage, 'Papers', 'title'), PaperPage],
+            'Report': [references.get(PaperIndexPage, 'Reports', 'title'), PaperPage],
+            'Podcast': [references.first(PodcastIndexPage), PodcastPage],
+        }
+        # Should only be one type of each index page
+        parent, page_type = page_types.get(options['type'], [None, None])
+        if not parent:
             raise CommandError(
                 f"Couldn't find Page Type with name {options['type']}, "
                 f"(Note: must be string), options are: {list(page_types.keys())}"
             )
         
         print('Found Page Type', parent, page_type)
+        self.type_name, self.page_type = options['type'], page_type
 
+        self.img_collection = references.get(Collection, 'prev img')
+        if not self.img_collection:
+            raise CommandError("Couldn't find the 'prev img' collection, create it first")
+        self.image_pipeline = HtmlPipeline(RewriteImages(self.get_image_url, 'imported-sr-img'))
+        self.download_btn_pipeline = HtmlPipeline(RemoveDownloadLink())
+        self.paper_collection = None
         if page_type is PaperPage:
             collection_name = 'Reports' if options['type'] == 'Report' else 'Papers'
-            self.paper_collection = Collection.objects.get(name=collection_name)
-
-        # import pages into new site
-        with open(options['the_file'], 'r') as f:
-            data = json.load(f)
-
-        for page in data['pages']:
-            content = page['content']
-            
-            print('Starting: ', content['title']) 
-            
-            slug = self.make_slug(options['type'], content['slug'], content['title'])
-            
-            with transaction.atomic():
-                new_page = page_type(
-                    title=content['title'],
-                    slug=slug,
-                    first_published_at=make_aware(datetime.strptime(content['date_display'], "%Y-%m-%d")),
-                    date_display=content['date_display'],
-                )
+            self.paper_collection = references.get(Collection, collection_name)
+            if not self.paper_collection:
+                raise CommandError(f"Couldn't find the {collection_name!r} collection, create it first")
+        return parent
 
-                if page_type is PaperPage:
-                    pdf = self.get_and_save_paper(content['paper'])
-                    new_page.paper = pdf
-                    body_content = self.remove_old_download_btn(content['body'])   
-                else:
-                    body_content = content['body']
+    @stage('build')
+    def build_page(self, content):
+        type_name, page_type = self.type_name, self.page_type
+        slug = self.make_slug(content['slug'], content['title'])
+        new_page = page_type(
+            title=content['title'],
+            slug=slug,
+            first_published_at=make_aware(datetime.strptime(content['date_display'], "%Y-%m-%d")),
+            date_display=content['date_display'],
+        )
 
-                new_body = [{'type': 'html', 'value': body_content}]
+        if page_type is PaperPage:
+            pdf = self.get_and_save_paper(content['paper'])
+            new_page.paper = pdf
+            body_content = self.remove_old_download_btn(content['body'])   
+        else:
+            body_content = content['body']
 
-                if options['type'] == 'Report' and content['report_html']:
-                    report_html = self.replace_body_images(content['report_html'])
-                    new_body.append({'type': 'html', 'value': report_html})
-                   
-                if page_type is PodcastPage:
-                    new_page.podcast_url = content['podcast_url']
-                
-                if page_type is GatedMediaPage:
-                    new_page.caption = content['caption'] if content['caption'] else ''
-                    body_content = self.replace_body_images(content['body'])
-                    new_body = [{'type': 'html', 'value': body_content}]                   
-                    new_body.append({
-                        "type": "embed_video", 
-                        "value": {
-                            "settings": {"custom_template": "", "custom_css_class": "", "custom_id": ""},
-                            "url": f"{content['youtube_link']}"
-                        }
-                    })
+        new_body = [{'type': 'html', 'value': body_content}]
 
-                new_page.body = json.dumps(new_body)
-                    
-                cover_image = self.get_and_save_image(content['cover_image']['src']) or ''
-                new_page.cover_image = cover_image
+        if type_name == 'Report' and content['report_html']:
+            report_html = self.replace_body_images(content['report_html'])
+            new_body.append({'type': 'html', 'value': report_html})
+           
+        if page_type is PodcastPage:
+            new_page.podcast_url = content['podcast_url']
+        
+        if page_type is GatedMediaPage:
+            new_page.caption = content['caption'] if content['caption'] else ''
+            body_content = self.replace_body_images(content['body'])
+            new_body = [{'type': 'html', 'value': body_content}]                   
+            new_body.append({
+                "type": "embed_video", 
+                "value": {
+                    "settings": {"custom_template": "", "custom_css_class": "", "custom_id": ""},
+                    "url": f"{content['youtube_link']}"
+                }
+            })
 
-                parent.add_child(instance=new_page)
-                
-                new_page.save()
-                new_page.save_revision().publish()
+        new_page.body = json.dumps(new_body)
             
-            self.stdout.write(f'Finished: {new_page.title}')
-            
-        f.close()
-        self.stdout.write(self.style.SUCCESS('All Done! Success!'))
+        cover_image = self.get_and_save_image(content['cover_image']['src']) or ''
+        new_page.cover_image = cover_image
 
-    def get_and_save_image(self, url):
-        if len(url) > 500:
-            img_name = f'old_img_{str(uuid.uuid4().hex.upper()[0:6])}.jpg'
-        else:
-            img_name = url.split("/")[-1]
-        self.stdout.write(f'Getting img: {img_name}...')
+        return new_page, []
 
-        try:
-            tmpfile, _ = urllib.request.urlretrieve(url)
-        except ValueError:
-            url = 'https://oldsite.com' + url
-            tmpfile, _ = urllib.request.urlretrieve(url)
-        cover_image = Image(
-            title=img_name, 
-            file=SimpleUploadedFile(img_name, open(tmpfile, "rb").read()), 
-            collection=self.img_collection)
-        cover_image.save()
-        if not cover_image:
-            self.stdout.write(self.style.WARNING(f'Something messed up with img at {url}'))
-        urllib.request.urlcleanup()
-        self.stdout.write('Success img')
-        return cover_image
-    
+    @stage('papers')
     def get_and_save_paper(self, url):
-        self.stdout.write(f'Getting PDF at: {url}')
         file_name = url.split("/")[-1]
-        tmpfile, _ = urllib.request.urlretrieve(url)
-        pdf = Document(
-            title=file_name.replace('.pdf', ''), 
-            file=SimpleUploadedFile(file_name, open(tmpfile, "rb").read()), 
-            collection=self.paper_collection)
-        pdf.save()
-        if not pdf:
-            self.stdout.write(self.style.WARNING(f'Something messed up with pdf at {url}'))
-        urllib.request.urlcleanup()
-        self.stdout.write('Success PDF')
-        return pdf
+        return self.get_and_save_asset(Document, url, file_name.replace('.pdf', ''), self.paper_collection, 'PDF')
     
-    def make_slug(self, page_type, url, title):
+    @stage('prefetch')
+    def get_asset_urls(self, content):
+        type_name, page_type = self.type_name, self.page_type
+        assets = [(Image, content['cover_image']['src'])]
+        if page_type is PaperPage:
+            assets.append((Document, content['paper']))
+        if type_name == 'Report' and content['report_html']:
+            assets.extend((Image, src) for src in self.parse_html(content['report_html']).img_srcs())
+        if page_type is GatedMediaPage:
+            assets.extend((Image, src) for src in self.parse_html(content['body']).img_srcs())
+        # Already imported ones come from the cache, no need to download them
+        return [url for model, url in assets if self.refresh_assets or not self.asset_cache.has_url(model, url)]
+
+    def prepare_job(self, content):
+        # What prepare_record does in a worker, same fields as get_asset_urls
+        type_name, page_type = self.type_name, self.page_type
+        html = {}
+        assets = [(Image, content['cover_image']['src'])]
+        if page_type is PaperPage:
+            assets.append((Document, content['paper']))
+            html[content['body']] = HtmlPipeline(RemoveDownloadLink())
+        if type_name == 'Report' and content['report_html']:
+            html[content['report_html']] = HtmlPipeline(RewriteImages(None, 'imported-sr-img'))
+        if page_type is GatedMediaPage:
+            html[content['body']] = HtmlPipeline(RewriteImages(None, 'imported-sr-img'))
+        return PrepareJob(content, html, assets)
+
+    def make_slug(self, url, title):
         stripper = {
             'GatedMedia': '/media/',
             'Paper': '/paper/',
             'Report': '/paper/',
             'Podcast': '/content/',
         }
-        try:
-            slug = url.replace(stripper[page_type], '') or ''
-            validate_slug(slug)
-            return slug
-        except exceptions.ValidationError:
-            print('Old slug invalid. New: ', slugify(title))
-            return slugify(title)
+        slug = url.replace(stripper[self.type_name], '') if url else None
+        return self.slug_index.claim(slug, title)
     
+    @stage('html')
     def remove_old_download_btn(self, body):
-        soup = BeautifulSoup(body, features="html5lib")
-        for elem in soup.findAll('a'):
-            if 'ownload' or 'DOWNLOAD' in elem.get_text():
-                elem.decompose()
-                break
-        return str(soup)
-    
-    def replace_body_images(self, body):
-        soup = BeautifulSoup(body, features="html5lib")
-        for elem in soup.findAll('img'):
-            new_img = self.get_and_save_image(elem['src'])
-            elem['src'] = new_img.file.url
-            elem['class'] = elem.get('class', []) + ['imported-sr-img']
-        return str(soup)
+        if body in self.prepared:
+            return self.prepared[body][0]
+        return self.download_btn_pipeline.run(self.parse_html(body)).html
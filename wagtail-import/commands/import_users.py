@@ -1,8 +1,9 @@
-import json
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from django.contrib.auth import get_user_model
 from core.models import UserProfile
+from ..utils.json_stream import iter_records
+from ..utils.metrics import ImportMetrics, stage
 
 User = get_user_model()
 
@@ -10,23 +11,36 @@ class Command(BaseCommand):
     help = "Imports from old site via json format"
     """
     Users will need to reset their password on first time login
+    Use --batched for big exports, loads existing emails once and bulk creates users + profiles in chunks
+    Sample Command: python manage.py import_users users.json --batched --batch-size 2000
     """
 
     def add_arguments(self, parser):
         parser.add_argument('the_file', help='the file to import')
+        parser.add_argument('--batched', action='store_true', help='bulk create users in chunks instead of one at a time')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Users per chunk with --batched')
+        parser.add_argument('--metrics-json', help='Also write the timing summary here')
+        parser.add_argument('--profile', help='Run under cProfile and dump the stats here')
 
 
     def handle(self, *args, **options):
-        
-        with open(options['the_file'], 'r') as f:
-            data = json.load(f)
+        self.metrics = ImportMetrics()
+        with self.metrics.instrument(options['profile']):
+            self.run_import(options)
+        self.metrics.report(self.stdout, options['metrics_json'])
+
+    def run_import(self, options):
 
-        for user in data['users']:
-            user = user['user']
+        if options['batched']:
+            return self.handle_batched(options)
+        
+        # Streamed one record at a time, also takes a .ndjson export
+        for user in iter_records(options['the_file'], 'users', 'user'):
             
+            self.metrics.start_record()
             print('Starting: ', user['email']) 
             
-            with transaction.atomic():
+            with self.metrics.stage('get_or_create'), transaction.atomic():
                 new_user, created = User.objects.get_or_create(
                     email=user['email'],
                     first_name=user['first_name'],
@@ -36,18 +50,63 @@ class Command(BaseCommand):
                 if created:
                     profile, c = UserProfile.objects.get_or_create(
                         user=new_user,
-                        org_type='',
-                        org_name=user['org_name'],
-                        is_private_org=True if user['is_private_org'] == 'Private' else False,
-                        job_title=user['job_title'],
-                        address=user['address'],
-                        city=user['city'],
-                        state=user['state'],
-                        zip_code=user['zip_code'],
-                        phone=user['phone'],
+                        **self.profile_fields(user)
                     )
             profile = locals().get('profile', 'Already Created')
             self.stdout.write(f"Finished: {new_user.email}, {profile}")
             
-        f.close()
         self.stdout.write(self.style.SUCCESS('All Done! Success!'))
+
+    def handle_batched(self, options):
+        # One query up front instead of a get_or_create per user
+        with self.metrics.stage('existing_emails'):
+            existing = set(User.objects.values_list('email', flat=True).iterator())
+        created = skipped = 0
+        batch = []
+
+        for user in iter_records(options['the_file'], 'users', 'user'):
+            self.metrics.start_record()
+            if user['email'] in existing:
+                skipped += 1
+                continue
+            # Also catches the same email twice in the export
+            existing.add(user['email'])
+            batch.append(user)
+            if len(batch) >= options['batch_size']:
+                created += self.create_batch(batch)
+                self.stdout.write(f'Created {created} users...')
+                batch = []
+
+        if batch:
+            created += self.create_batch(batch)
+        self.stdout.write(self.style.SUCCESS(f'All Done! Created: {created}, Skipped (already exist): {skipped}'))
+
+    @stage('bulk_insert')
+    @transaction.atomic
+    def create_batch(self, batch):
+        User.objects.bulk_create([
+            User(email=user['email'], first_name=user['first_name'], last_name=user['last_name'])
+            for user in batch
+        ])
+        # Not every database backend sets pks from bulk_create, so look them up
+        user_ids = dict(
+            User.objects.filter(email__in=[user['email'] for user in batch]).values_list('email', 'pk')
+        )
+        UserProfile.objects.bulk_create([
+            UserProfile(user_id=user_ids[user['email']], **self.profile_fields(user))
+            for user in batch
+        ])
+        return len(batch)
+
+    def profile_fields(self, user):
+        return {
+            'org_type': '',
+            'org_name': user['org_name'],
+            'is_private_org': True if user['is_private_org'] == 'Private' else False,
+            'job_title': user['job_title'],
+            'address': user['address'],
+            'city': user['city'],
+            'state': user['state'],
+            'zip_code': user['zip_code'],
+            'phone': user['phone'],
+        }
@@ -0,0 +1,89 @@
+import difflib
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from website.models import PaperPage
+from ..utils.html_pipeline import ExtractText, HtmlPipeline, StripTags
+
+text_pipeline = HtmlPipeline(StripTags(), ExtractText())
+
+
+def strip_html(html):
+    return text_pipeline.run(html).text
+
+
+class Command(BaseCommand):
+    help = "Replaces imported paper html bodies with their plain text"
+    """
+    Streams the papers in chunks, pulls the text out of each body in a pool of processes and writes
+    each chunk back with one bulk_update of the body field (no full page save per paper).
+    Papers already stripped are skipped so it can be rerun. Like before, no new revision is made
+    Sample Command: python manage.py strip_html_papers --workers 4 --dry-run --diff
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--collection', default='Papers', help='Only papers whose pdf is in this collection')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Papers loaded and written per chunk')
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='Processes for parsing html')
+        parser.add_argument('--dry-run', action='store_true', help="Don't save anything, only report what would change")
+        parser.add_argument('--diff', action='store_true', help='Print a diff of each changed body')
+
+
+    def handle(self, *args, **options):
+        papers = PaperPage.objects.filter(
+            paper__collection__name=options['collection']
+        ).only('id', 'title', 'body').order_by('pk')
+        total = papers.count()
+        self.stdout.write(f'{total} papers to check')
+
+        # The pool only forks on its first submit, so make it start the workers now, after closing the db connections
+        # and before the queryset opens its cursor, so no worker inherits a db connection
+        connections.close_all()
+        pool = ProcessPoolExecutor(max_workers=options['workers'], mp_context=multiprocessing.get_context('fork'))
+        pool.submit(int).result()
+        done = changed = 0
+        start = time.monotonic()
+        chunk = []
+        with pool:
+            for paper in papers.iterator(chunk_size=options['chunk_size']):
+                chunk.append(paper)
+                if len(chunk) >= options['chunk_size']:
+                    changed += self.strip_chunk(pool, chunk, options)
+                    done += len(chunk)
+                    chunk = []
+                    self.progress(done, total, changed, start)
+            if chunk:
+                changed += self.strip_chunk(pool, chunk, options)
+                done += len(chunk)
+                self.progress(done, total, changed, start)
+
+        verb = 'Would change' if options['dry_run'] else 'Changed'
+        self.stdout.write(self.style.SUCCESS(f'All Done! {verb} {changed} of {done} papers'))
+
+    def strip_chunk(self, pool, chunk, options):
+        # Ones already stripped to a text block are left alone
+        papers = [paper for paper in chunk if paper.body and paper.body[0].block_type != 'text']
+        if not papers:
+            return 0
+        bodies = [str(paper.body[0].value) for paper in papers]
+        texts = list(pool.map(strip_html, bodies, chunksize=max(1, len(bodies) // (options['workers'] * 4))))
+
+        for paper, body, text in zip(papers, bodies, texts):
+            if options['diff']:
+                self.stdout.write(f'--- {paper.pk}: {paper.title}')
+                self.stdout.writelines(difflib.unified_diff(
+                    body.splitlines(keepends=True), [text + '\n'], 'html', 'text'
+                ))
+            paper.body = json.dumps([{'type': 'text', 'value': text}])
+
+        if not options['dry_run']:
+            with transaction.atomic():
+                PaperPage.objects.bulk_update(papers, ['body'])
+        return len(papers)
+
+    def progress(self, done, total, changed, start):
+        rate = done / max(time.monotonic() - start, 0.001)
+        self.stdout.write(f'{done}/{total} checked, {changed} changed, {rate:.0f} papers/sec')
@@ -0,0 +1,41 @@
+import multiprocessing
+from django.core.management.base import BaseCommand, CommandError
+from wagtail.images import get_image_model
+from ..utils.renditions import filter_specs, warm_renditions
+
+
+class Command(BaseCommand):
+    help = "Generates image renditions ahead of time so page views don't have to"
+    """
+    Renditions that already exist are skipped, so it's fine to rerun.
+    Specs default to IMPORT_RENDITION_FILTERS in settings.
+    Sample Command: python manage.py warm_renditions --collection 'prev img' --workers 4
+    Or with ids: python manage.py warm_renditions 12 13 14 --filters fill-300x200 width-800
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('image_ids', nargs='*', type=int, help='Image ids to warm')
+        parser.add_argument('--ids-file', help='File with one image id per line')
+        parser.add_argument('--collection', help='Warm every image in this collection')
+        parser.add_argument('--filters', nargs='+', help='Filter specs, ex: fill-300x200 width-800')
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='Processes making renditions')
+
+
+    def handle(self, *args, **options):
+        image_ids = list(options['image_ids'])
+        if options['ids_file']:
+            with open(options['ids_file']) as f:
+                image_ids.extend(int(line) for line in f if line.strip())
+        if options['collection']:
+            image_ids.extend(get_image_model().objects.filter(
+                collection__name=options['collection']
+            ).values_list('pk', flat=True))
+        if not image_ids:
+            raise CommandError('Plz give image ids, an --ids-file or a --collection')
+
+        specs = options['filters'] or filter_specs()
+        self.stdout.write(f'Warming {len(specs)} renditions for {len(set(image_ids))} images')
+        made, skipped, failed = warm_renditions(image_ids, specs, options['workers'], self.stdout)
+        if failed:
+            self.stdout.write(self.style.WARNING(f'{len(failed)} images failed: {failed}'))
+        self.stdout.write(self.style.SUCCESS(f'All Done! Made {made} renditions, {skipped} already existed'))
@@ -0,0 +1,63 @@
+import sqlite3
+
+
+class AssetCache:
+    """ Sidecar sqlite file that remembers which Image/Document was made from which url and file content.
+    Lets the import commands reuse an asset when the same url shows up again (same logo in 500 article bodies)
+    or when a different url serves the exact same file, and carries over between runs so reruns don't
+    download and store everything again.
+    Entries are keyed by model label so images and documents don't mix
+    """
+
+    def __init__(self, path='import_asset_cache.sqlite3'):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS url_asset (
+                kind TEXT NOT NULL, url TEXT NOT NULL, asset_id INTEGER NOT NULL, PRIMARY KEY (kind, url)
+            );
+            CREATE TABLE IF NOT EXISTS hash_asset (
+                kind TEXT NOT NULL, sha1 TEXT NOT NULL, asset_id INTEGER NOT NULL, PRIMARY KEY (kind, sha1)
+            );
+        """)
+
+    def by_url(self, model, url):
+        row = self.db.execute(
+            'SELECT asset_id FROM url_asset WHERE kind = ? AND url = ?', (model._meta.label_lower, url)
+        ).fetchone()
+        return self._load(model, row)
+
+    def by_hash(self, model, sha1):
+        row = self.db.execute(
+            'SELECT asset_id FROM hash_asset WHERE kind = ? AND sha1 = ?', (model._meta.label_lower, sha1)
+        ).fetchone()
+        return self._load(model, row)
+
+    def has_url(self, model, url):
+        return self.db.execute(
+            'SELECT 1 FROM url_asset WHERE kind = ? AND url = ?', (model._meta.label_lower, url)
+        ).fetchone() is not None
+
+    def add(self, asset, url, sha1=None):
+        kind = asset._meta.label_lower
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO url_asset VALUES (?, ?, ?)', (kind, url, asset.pk))
+            if sha1:
+                self.db.execute('INSERT OR REPLACE INTO hash_asset VALUES (?, ?, ?)', (kind, sha1, asset.pk))
+
+    def forget(self, model, asset_id):
+        kind = model._meta.label_lower
+        with self.db:
+            self.db.execute('DELETE FROM url_asset WHERE kind = ? AND asset_id = ?', (kind, asset_id))
+            self.db.execute('DELETE FROM hash_asset WHERE kind = ? AND asset_id = ?', (kind, asset_id))
+
+    def close(self):
+        self.db.close()
+
+    def _load(self, model, row):
+        if row is None:
+            return None
+        asset = model.objects.filter(pk=row[0]).first()
+        if asset is None:
+            # Deleted on the site or its page transaction rolled back, don't hand it out again
+            self.forget(model, row[0])
+        return asset
@@ -0,0 +1,77 @@
+import json
+import os
+
+
+class ImportJournal:
+    """ Append-only record of which export records made it into the database.
+    One json line per record with its source key and the new page id, written after the record's transaction
+    commits, so a run that dies part way can be started again with --resume and skip everything already done.
+    Records that fail are written to a retry file in the same format as an .ndjson export,
+    so just those can be imported again on their own: python manage.py import_pages export.json.retry.ndjson
+    Each retry line also names this journal, importing the retry file records into it by default (see journal_for),
+    so a later --resume of the original export skips what the retry got in
+    """
+
+    def __init__(self, path, retry_path):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line may be cut off if the process was killed mid-write
+                        continue
+                    if entry['status'] == 'done':
+                        self.done[entry['key']] = entry['page_id']
+        self.file = open(path, 'a')
+        self.retry_path = retry_path
+        self.retry_file = None
+        self.failed = 0
+
+    @staticmethod
+    def key(content):
+        for field in ('id', 'nid', 'slug'):
+            if content.get(field):
+                return str(content[field])
+        return content['title']
+
+    def is_done(self, key):
+        return key in self.done
+
+    def mark_done(self, key, page_id):
+        self.done[key] = page_id
+        self._write({'key': key, 'status': 'done', 'page_id': page_id})
+
+    def mark_failed(self, key, content, error):
+        self.failed += 1
+        self._write({'key': key, 'status': 'failed', 'error': str(error)})
+        if self.retry_file is None:
+            # Only holds this run's failures
+            self.retry_file = open(self.retry_path, 'w')
+        self.retry_file.write(json.dumps({'content': content, 'journal': os.path.abspath(self.path)}) + '\n')
+        self.retry_file.flush()
+
+    def close(self):
+        self.file.close()
+        if self.retry_file:
+            self.retry_file.close()
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+
+def journal_for(path):
+    """ The journal a retry file's records came from, None for other exports """
+    if not path.endswith('.ndjson'):
+        return None
+    with open(path, 'r') as f:
+        first = f.readline().strip()
+    try:
+        entry = json.loads(first) if first else None
+    except ValueError:
+        return None
+    return entry.get('journal') if isinstance(entry, dict) else None
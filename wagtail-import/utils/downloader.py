@@ -0,0 +1,210 @@
+import hashlib
+import http.client
+import os
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+from .storage import HashingReader
+
+# sha1 is worked out while the file is written so dedup doesn't need to read it back.
+# path is a temp file, or the storage name when the downloader was given a storage
+DownloadedFile = namedtuple('DownloadedFile', ['path', 'sha1', 'size'])
+
+
+class AssetDownloader:
+    """ Shared downloader for the import commands.
+    Fetching every image/pdf with urllib.request.urlretrieve opens a new connection per file and the
+    import waits on each one. This keeps a bounded pool of worker threads, each holding one keep-alive
+    connection per host, and retries with backoff on connection errors and 5xx responses.
+    Call prefetch() with all the urls a page needs before opening its transaction, then fetch() hands back
+    a DownloadedFile (waiting only if that url isn't done yet).
+    With a storage (and upload_to(url, content_type) for the name) files are streamed from the response
+    straight into it in chunks instead of going through a temp file
+    """
+    redirect_codes = (301, 302, 303, 307, 308)
+    chunk_size = 64 * 1024
+    # Image and Document file fields
+    max_length = 100
+
+    def __init__(self, workers=8, base_url='https://oldsite.com', retries=3, backoff=0.5, timeout=30,
+                 storage=None, upload_to=None):
+        self.base_url = base_url
+        self.storage = storage
+        self.upload_to = upload_to
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='asset-dl')
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._all_connections = []
+
+    def absolute_url(self, url):
+        # Old content has relative links like /sites/default/files/...
+        if url.startswith('//'):
+            return 'https:' + url
+        if not urlsplit(url).scheme:
+            return urljoin(self.base_url + '/', url.lstrip('/'))
+        return url
+
+    def prefetch(self, urls):
+        for url in urls:
+            if url:
+                self._submit(url)
+
+    def fetch(self, url):
+        """ Returns a DownloadedFile for the url, raises urllib.error.HTTPError on 4xx """
+        return self._submit(url).result()
+
+    def discard(self, url, delete=True):
+        """ Drop a finished download, delete=False once its file belongs to a saved asset """
+        with self._lock:
+            future = self._futures.pop(url, None)
+        if delete and future and future.done() and not future.exception():
+            self._remove(future.result().path)
+
+    def adopt(self, url, result):
+        """ Hand over a file (or the error) some other process already downloaded, fetch() returns/raises it """
+        future = Future()
+        if isinstance(result, BaseException):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+        with self._lock:
+            self._futures[url] = future
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for url in list(self._futures):
+            self.discard(url)
+        for conn in self._all_connections:
+            conn.close()
+
+    def _submit(self, url):
+        with self._lock:
+            future = self._futures.get(url)
+            if future is None:
+                future = self.executor.submit(self._download, url)
+                self._futures[url] = future
+            return future
+
+    def _connection(self, scheme, host):
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get((scheme, host))
+        if conn is None:
+            conn_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            conn = conns[(scheme, host)] = conn_class(host, timeout=self.timeout)
+            with self._lock:
+                self._all_connections.append(conn)
+        return conn
+
+    def _drop_connection(self, scheme, host):
+        conn = getattr(self._local, 'conns', {}).pop((scheme, host), None)
+        if conn:
+            conn.close()
+
+    def _download(self, url):
+        target = self.absolute_url(url)
+        for attempt in range(self.retries + 1):
+            try:
+                return self._get(target)
+            except urllib.error.HTTPError as e:
+                if e.code < 500 or attempt == self.retries:
+                    raise
+            except (OSError, http.client.HTTPException):
+                if attempt == self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def _get(self, url, redirects=5):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            # data: uris inlined in old bodies, nothing to pool
+            with urllib.request.urlopen(url, timeout=self.timeout) as resp:
+                return self._write(resp, parts, url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        conn = self._connection(parts.scheme, parts.netloc)
+        try:
+            conn.request('GET', path, headers={'Connection': 'keep-alive', 'User-Agent': 'wagtail-import'})
+            resp = conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            # Server may have closed an idle keep-alive connection, next attempt reconnects
+            self._drop_connection(parts.scheme, parts.netloc)
+            raise
+
+        if resp.status in self.redirect_codes and redirects:
+            resp.read()
+            return self._get(urljoin(url, resp.getheader('Location')), redirects - 1)
+        if resp.status >= 400:
+            resp.read()
+            raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+
+        downloaded = self._write(resp, parts, url)
+        if resp.will_close:
+            self._drop_connection(parts.scheme, parts.netloc)
+        return downloaded
+
+    def _write(self, resp, parts, url):
+        if self.storage is not None:
+            return self._store(resp, parts, url)
+        fd, tmpfile = tempfile.mkstemp(prefix='import-')
+        sha1 = hashlib.sha1()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = resp.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    sha1.update(chunk)
+                    size += len(chunk)
+                    out.write(chunk)
+        except BaseException:
+            self._drop_connection(parts.scheme, parts.netloc)
+            self._remove(tmpfile)
+            raise
+        return DownloadedFile(tmpfile, sha1.hexdigest(), size)
+
+    def _store(self, resp, parts, url):
+        name = self.unique_name(self.upload_to(url, resp.headers.get_content_type()))
+        reader = HashingReader(resp, name)
+        try:
+            name = self.storage.save(name, reader, max_length=self.max_length)
+        except BaseException:
+            self._drop_connection(parts.scheme, parts.netloc)
+            self._remove(name)
+            raise
+        return DownloadedFile(name, reader.sha1.hexdigest(), reader.bytes_read)
+
+    def unique_name(self, name):
+        """ name with a random suffix, the same way the storage renames on a clash. No other download gets it,
+        so save() writes to exactly this name and a half written file can be removed without touching anyone else's
+        """
+        dir_name, file_name = os.path.split(name)
+        root, ext = os.path.splitext(file_name)
+        unique = os.path.join(dir_name, self.storage.get_alternative_name(root, ext))
+        excess = len(unique) - self.max_length
+        if excess > 0:
+            # Shortened here rather than by save(), which would pick yet another name
+            unique = os.path.join(dir_name, self.storage.get_alternative_name(root[:-excess], ext))
+        return unique
+
+    def _remove(self, path):
+        try:
+            if self.storage is not None:
+                self.storage.delete(path)
+            else:
+                os.remove(path)
+        except Exception:
+            pass
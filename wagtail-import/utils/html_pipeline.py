@@ -0,0 +1,123 @@
+from bs4 import BeautifulSoup
+
+try:
+    import lxml  # noqa: F401
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+
+class Transform:
+    """ One change applied to the parsed html. `tags` are the element names it wants to be called with,
+    finish() runs once after the walk for anything that needs the whole document
+    """
+    tags = ()
+
+    def __call__(self, elem, doc):
+        pass
+
+    def finish(self, doc):
+        pass
+
+
+class RewriteImages(Transform):
+    """ Points each <img> at a new url from resolve(src), img is removed if resolve returns None """
+    tags = ('img',)
+
+    def __init__(self, resolve, css_class=None):
+        self.resolve = resolve
+        self.css_class = css_class
+
+    def __call__(self, elem, doc):
+        new_src = self.resolve(elem['src']) if elem.get('src') else None
+        if not new_src:
+            elem.decompose()
+            return
+        elem['src'] = new_src
+        if self.css_class:
+            elem['class'] = elem.get('class', []) + [self.css_class]
+
+
+class RemoveDownloadLink(Transform):
+    """ Removes the first link that is the old site's download button """
+    tags = ('a',)
+
+    def __call__(self, elem, doc):
+        if doc.state.get('download_link_removed'):
+            return
+        if 'download' in elem.get_text().lower():
+            elem.decompose()
+            doc.state['download_link_removed'] = True
+
+
+class StripTags(Transform):
+    tags = ('script', 'style')
+
+    def __call__(self, elem, doc):
+        elem.decompose()
+
+
+class ExtractText(Transform):
+    """ Puts the visible text, whitespace collapsed, on doc.text """
+
+    def finish(self, doc):
+        doc.text = ' '.join(doc.soup.stripped_strings)
+
+
+class HtmlDocument:
+    def __init__(self, html, parser=PARSER):
+        self.soup = BeautifulSoup(html or '', features=parser)
+        self.text = None
+        self.state = {}
+
+    def img_srcs(self):
+        return [elem['src'] for elem in self.soup.find_all('img', src=True)]
+
+    @property
+    def html(self):
+        # lxml wraps fragments in <html><body>, only the fragment goes back into a StreamField. It also moves
+        # leading <style>/<script>/<meta>/<link> into <head>, those came first so they go back in front
+        parts = [elem.decode_contents() for elem in (self.soup.head, self.soup.body) if elem is not None]
+        return ''.join(parts) if parts else self.soup.decode()
+
+
+class HtmlPipeline:
+    """ Parse once, apply every registered transform in one walk over the tree, serialize once.
+    Replaces parsing the same body with html5lib in remove_old_download_btn, replace_body_images and
+    strip_html_papers. Uses lxml when it's installed, falls back to the stdlib parser otherwise.
+    Sample:
+        pipeline = HtmlPipeline(StripTags(), RewriteImages(resolve_url), ExtractText())
+        doc = pipeline.run(body)
+        doc.html, doc.text
+    """
+
+    def __init__(self, *transforms, parser=PARSER):
+        self.transforms = list(transforms)
+        self.parser = parser
+
+    def register(self, transform):
+        self.transforms.append(transform)
+        return transform
+
+    def parse(self, html):
+        return HtmlDocument(html, self.parser)
+
+    def run(self, html_or_doc):
+        """ Takes html or an already parsed HtmlDocument (parsed earlier to find image urls) """
+        doc = html_or_doc if isinstance(html_or_doc, HtmlDocument) else self.parse(html_or_doc)
+        by_tag = {}
+        for transform in self.transforms:
+            for tag in transform.tags:
+                by_tag.setdefault(tag, []).append(transform)
+        if by_tag:
+            for elem in doc.soup.find_all(list(by_tag)):
+                # Went with a parent that was removed earlier in the walk
+                if elem.decomposed:
+                    continue
+                for transform in by_tag[elem.name]:
+                    transform(elem, doc)
+                    if elem.decomposed:
+                        break
+        for transform in self.transforms:
+            transform.finish(doc)
+        return doc
@@ -0,0 +1,251 @@
+import uuid
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from wagtail.images.models import AbstractImage, Image
+from .asset_cache import AssetCache
+from .bulk_tree import BulkPageInserter
+from .checkpoint import ImportJournal, journal_for
+from .downloader import AssetDownloader
+from .json_stream import iter_records
+from .metrics import ImportMetrics, stage
+from .parallel import adopt_downloads, fill_placeholders, make_pool, ordered_imap, prepare_record
+from .reference_cache import references
+from .renditions import warm_renditions
+from .slug_index import SlugIndex
+from .storage import stored_asset, upload_name
+
+
+class ImportCommand(BaseCommand):
+    """ What import_articles and import_pages share: the options, streaming records from the export with the journal,
+    prefetching downloads (or preparing records in a worker pool), writing pages one add_child() at a time or with
+    --bulk, saving images/documents from downloaded files, and warming renditions afterwards.
+    A command sets image_pipeline in setup() and fills in:
+        setup(options): checks options, loads collections etc., returns the parent page
+        build_page(content): returns (page, tag names)
+        get_asset_urls(content): urls to start downloading before the page is built
+        prepare_job(content): the PrepareJob for --workers, same urls as get_asset_urls
+    """
+    # For the help text
+    asset_label = 'images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--download-workers', type=int, default=8, help=f'Number of parallel {self.asset_label} downloads')
+        parser.add_argument('--asset-cache', default='import_asset_cache.sqlite3', help=f'File to remember imported {self.asset_label} in')
+        parser.add_argument('--refresh-assets', action='store_true', help=f'Download {self.asset_label} again even if already imported')
+        parser.add_argument('--bulk', action='store_true', help='Insert pages in batches instead of one add_child() each')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Pages per batch with --bulk')
+        parser.add_argument('--workers', type=int, default=1, help='Processes for parsing html and downloading, pages are still written in order')
+        parser.add_argument('--resume', action='store_true', help='Skip records the journal says were already imported')
+        parser.add_argument('--journal', help="Checkpoint file, default is <the_file>.journal or for a retry file the journal it came from")
+        parser.add_argument('--retry-file', help='Where failed records go, default is <the_file>.retry.ndjson')
+        parser.add_argument('--metrics-json', help='Also write the timing summary here')
+        parser.add_argument('--profile', help='Run under cProfile and dump the stats here')
+        parser.add_argument('--warm-renditions', action='store_true', help='Generate renditions for the new images after importing')
+
+    def handle(self, *args, **options):
+        self.metrics = ImportMetrics()
+        with self.metrics.instrument(options['profile']):
+            self.run_import(options)
+        self.metrics.report(self.stdout, options['metrics_json'])
+
+    def run_import(self, options):
+        parent = self.setup(options)
+        # Files are streamed into storage as they download, the Image/Document is then saved pointing at them
+        self.downloader = AssetDownloader(
+            workers=options['download_workers'], storage=default_storage, upload_to=upload_name
+        )
+        self.asset_cache = AssetCache(options['asset_cache'])
+        self.refresh_assets = options['refresh_assets']
+        self.imported_images = []
+        self.new_assets = []
+        # Sibling slugs loaded once, make_slug checks against these so clashes don't fail at add_child
+        self.slug_index = SlugIndex(parent)
+        inserter = BulkPageInserter(parent, options['chunk_size'], self.slug_index) if options['bulk'] else None
+        batch = []
+        journal = ImportJournal(
+            # A retry file goes back into the journal of the run it came from
+            options['journal'] or journal_for(options['the_file']) or f"{options['the_file']}.journal",
+            options['retry_file'] or f"{options['the_file']}.retry.ndjson",
+        )
+
+        for key, content in self.prepared_records(options, journal):
+
+            self.metrics.start_record()
+            self.new_assets = []
+            print('Starting: ', content['title'])
+
+            if inserter:
+                try:
+                    new_page, tags = self.build_page(content)
+                except Exception as e:
+                    self.record_failed(journal, key, content, e)
+                    continue
+                batch.append((key, content))
+                if inserter.add(new_page, tags):
+                    self.flush_batch(inserter, batch, journal)
+                continue
+
+            try:
+                with transaction.atomic():
+                    new_page, tags = self.build_page(content)
+
+                    with self.metrics.stage('add_child'):
+                        parent.add_child(instance=new_page)
+
+                    if tags:
+                        new_page.tags.add(*references.tags(type(new_page).tags.through.tag_model(), tags))
+
+                    with self.metrics.stage('publish'):
+                        new_page.save()
+                        new_page.save_revision().publish()
+            except Exception as e:
+                self.remove_new_files()
+                self.record_failed(journal, key, content, e)
+                continue
+
+            journal.mark_done(key, new_page.pk)
+            self.stdout.write(f'Finished: {new_page.title}')
+
+        if inserter:
+            self.flush_batch(inserter, batch, journal)
+
+        self.downloader.close()
+        self.asset_cache.close()
+        journal.close()
+        self.after_import(options)
+        if journal.failed:
+            self.stdout.write(self.style.WARNING(f'{journal.failed} failed, retry them with: {journal.retry_path}'))
+        self.stdout.write(self.style.SUCCESS('All Done! Success!'))
+
+    def after_import(self, options):
+        if not self.imported_images:
+            return
+        # Ids of the new images, for warm_renditions --ids-file later on
+        ids_path = f"{options['the_file']}.images"
+        with open(ids_path, 'w') as f:
+            f.writelines(f'{pk}\n' for pk in self.imported_images)
+        if not options['warm_renditions']:
+            self.stdout.write(f'Warm their renditions with: python manage.py warm_renditions --ids-file {ids_path}')
+            return
+        with self.metrics.stage('renditions'):
+            made, skipped, failed = warm_renditions(
+                self.imported_images, workers=options['workers'] if options['workers'] > 1 else None, stdout=self.stdout
+            )
+        self.stdout.write(f'Renditions: {made} made, {skipped} already existed, {len(failed)} images failed')
+
+    def prepared_records(self, options, journal):
+        """ Yields (key, content) for each record to import once its html and downloads are ready """
+        records = self.pending_records(options, journal)
+        self.prepared, self.adopted = {}, []
+        if options['workers'] > 1:
+            # Parsing, rewriting and downloading happen in a process pool, pages are still written here in export order
+            pool = make_pool(options['workers'], options['download_workers'], options['asset_cache'], self.refresh_assets)
+            with pool:
+                jobs = (self.prepare_job(content) for key, content in records)
+                results = ordered_imap(pool, prepare_record, jobs, options['workers'] * 4)
+                for job, prepared in self.metrics.timed_iter('workers', results):
+                    self.parsed, self.prepared = {}, prepared.html
+                    self.adopted = adopt_downloads(self.downloader, prepared, self.adopted)
+                    yield journal.key(job.content), job.content
+            return
+
+        for key, content in records:
+            # Downloads run in the background so the transaction only waits on the network if it has to
+            self.parsed = {}
+            self.downloader.prefetch(self.get_asset_urls(content))
+            yield key, content
+
+    def pending_records(self, options, journal):
+        # Streamed one record at a time, also takes a .ndjson export
+        for content in iter_records(options['the_file'], 'pages', 'content'):
+            key = journal.key(content)
+            if options['resume'] and journal.is_done(key):
+                print('Already imported, skipping: ', content['title'])
+                continue
+            yield key, content
+
+    @stage('bulk_insert')
+    def flush_batch(self, inserter, batch, journal):
+        try:
+            pages = inserter.flush()
+        except Exception as e:
+            # The whole batch rolled back
+            for key, content in batch:
+                self.record_failed(journal, key, content, e)
+        else:
+            for (key, _), page in zip(batch, pages):
+                journal.mark_done(key, page.pk)
+                self.stdout.write(f'Finished: {page.title}')
+        batch.clear()
+
+    def record_failed(self, journal, key, content, error):
+        self.stdout.write(self.style.ERROR(f"Failed: {content['title']}, {error!r}"))
+        journal.mark_failed(key, content, error)
+
+    @stage('images')
+    def get_and_save_image(self, url):
+        if len(url) > 500:
+            img_name = f'old_img_{str(uuid.uuid4().hex.upper()[0:6])}.jpg'
+        else:
+            img_name = url.split("/")[-1]
+        return self.get_and_save_asset(Image, url, img_name, self.img_collection, 'img')
+
+    def get_and_save_asset(self, model, url, title, collection, label):
+        """ Image/Document for the url, reused from the asset cache by url or by file hash when it was imported before """
+        if not self.refresh_assets:
+            cached = self.asset_cache.by_url(model, url) or self.new_asset(model, url=url)
+            if cached:
+                self.stdout.write(f'Reusing {label}: {cached.title}')
+                return cached
+
+        self.stdout.write(f'Getting {label}: {title}...')
+        with self.metrics.stage('download_wait'):
+            downloaded = self.downloader.fetch(url)
+        self.metrics.downloaded(downloaded)
+        # Same file under a different url
+        asset = self.asset_cache.by_hash(model, downloaded.sha1) or self.new_asset(model, sha1=downloaded.sha1)
+        if asset:
+            self.stdout.write(f'Reusing {label}: {asset.title}')
+        else:
+            asset = stored_asset(model, downloaded, title=title, collection=collection)
+            asset.save()
+            self.new_assets.append((asset, url, downloaded.sha1))
+            if isinstance(asset, AbstractImage):
+                transaction.on_commit(lambda: self.imported_images.append(asset.pk))
+            self.stdout.write(f'Success {label}')
+        # Only remembered once the record commits, a rolled back one would leave ids that don't exist
+        transaction.on_commit(lambda: self.asset_cache.add(asset, url, downloaded.sha1))
+        # The stored file stays if it's now this asset's, otherwise it was a duplicate
+        self.downloader.discard(url, delete=asset.file.name != downloaded.path)
+        return asset
+
+    def new_asset(self, model, url=None, sha1=None):
+        # Saved earlier in this record's transaction, not in the asset cache until it commits
+        for asset, asset_url, asset_sha1 in self.new_assets:
+            if isinstance(asset, model) and (asset_url == url or asset_sha1 == sha1):
+                return asset
+        return None
+
+    def remove_new_files(self):
+        """ The record's transaction rolled back, its new assets' rows are gone so their stored files go too """
+        for asset, _, _ in self.new_assets:
+            asset.file.storage.delete(asset.file.name)
+        self.new_assets = []
+
+    def parse_html(self, html):
+        # Each html field is parsed once per record, the same tree gives the image urls and then gets rewritten
+        if html not in self.parsed:
+            self.parsed[html] = self.image_pipeline.parse(html)
+        return self.parsed[html]
+
+    def get_image_url(self, src):
+        new_img = self.get_and_save_image(src)
+        return new_img.file.url if new_img else None
+
+    @stage('html')
+    def replace_body_images(self, body):
+        if body in self.prepared:
+            # Already rewritten in a worker, just needs the saved images' urls
+            return fill_placeholders(*self.prepared[body], self.get_image_url)
+        return self.image_pipeline.run(self.parse_html(body)).html
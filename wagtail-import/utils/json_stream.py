@@ -0,0 +1,105 @@
+import json
+
+
+def iter_records(path, key, inner=None, chunk_size=1024 * 1024):
+    """ Yields records from an export one at a time instead of json.load()ing the whole thing.
+    Handles the normal export shape ({"pages": [{"content": {...}}, ...]}) by decoding one list item at a
+    time, so memory stays flat no matter how big the file is.
+    Also takes NDJSON (.ndjson/.jsonl), one record per line, either wrapped ({"content": {...}}) or bare.
+    With inner='content' each wrapped record is unwrapped before being yielded
+    """
+    if path.endswith(('.ndjson', '.jsonl')):
+        records = _iter_ndjson(path)
+    else:
+        records = _iter_array(path, key, chunk_size)
+    for record in records:
+        if inner and isinstance(record, dict) and inner in record:
+            record = record[inner]
+        yield record
+
+
+def _iter_ndjson(path):
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class _Reader:
+    """ Buffer over the file that lets raw_decode work on values that span chunk boundaries """
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        # Drop what's been consumed so the buffer only ever holds about one record.
+        # Reads at least as much as is already buffered so a big record isn't re-decoded over and over
+        chunk = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+        return bool(chunk)
+
+    def peek(self):
+        """ Next non-whitespace character, '' at end of file """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'Expected {char!r} at {self.pos} in export, got {self.peek()!r}')
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A number right at the end of the buffer may have been cut off, make sure something follows it
+            if end == len(self.buf) and not self.eof:
+                self.fill()
+                continue
+            self.pos = end
+            return obj
+
+    def items(self):
+        self.expect('[')
+        while self.peek() != ']':
+            yield self.value()
+            if self.peek() == ',':
+                self.pos += 1
+        self.pos += 1
+
+
+def _iter_array(path, key, chunk_size):
+    with open(path, 'r') as f:
+        reader = _Reader(f, chunk_size)
+        reader.expect('{')
+        while reader.peek() != '}':
+            name = reader.value()
+            reader.expect(':')
+            if name == key:
+                yield from reader.items()
+            elif reader.peek() == '[':
+                # Skip other big lists (users in a pages export) without holding them in memory
+                for _ in reader.items():
+                    pass
+            else:
+                reader.value()
+            if reader.peek() == ',':
+                reader.pos += 1
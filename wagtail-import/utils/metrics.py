@@ -0,0 +1,139 @@
+import cProfile
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+from django.db import connection
+
+
+class ImportMetrics:
+    """ Where an import spends its time: wall time and db queries per stage, queries per record and bytes
+    downloaded. Stage times don't overlap, a stage inside another (download_wait inside images) is taken
+    out of the outer one, so the table adds up to the total.
+    Sample:
+        metrics = ImportMetrics()
+        with metrics.instrument(profile_path):
+            with metrics.stage('html'):
+                ...
+        metrics.report(self.stdout, 'metrics.json')
+    """
+
+    def __init__(self):
+        self.stages = defaultdict(float)
+        self.stage_queries = defaultdict(int)
+        self.stage_calls = defaultdict(int)
+        self.record_queries = []
+        self.records = 0
+        self.queries = 0
+        self.bytes_downloaded = 0
+        self.files_downloaded = 0
+        self.total = 0.0
+        self._stack = []
+        self._record_start = None
+
+    @contextmanager
+    def instrument(self, profile_path=None):
+        """ Counts queries for the whole run, optionally under cProfile (open the dump with snakeviz/pstats) """
+        profiler = cProfile.Profile() if profile_path else None
+        start = time.perf_counter()
+        with connection.execute_wrapper(self._count_query):
+            with profiler or nullcontext():
+                try:
+                    yield self
+                finally:
+                    self.finish_record()
+                    self.total = time.perf_counter() - start
+        if profiler:
+            profiler.dump_stats(profile_path)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        self._stack.append([name, 0.0])
+        try:
+            yield
+        finally:
+            _, inner = self._stack.pop()
+            elapsed = time.perf_counter() - start
+            self.stages[name] += elapsed - inner
+            self.stage_calls[name] += 1
+            if self._stack:
+                self._stack[-1][1] += elapsed
+
+    def timed_iter(self, name, iterable):
+        """ Time spent waiting on each item of an iterator (results coming back from workers) """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def start_record(self):
+        self.finish_record()
+        self.records += 1
+        self._record_start = self.queries
+
+    def finish_record(self):
+        if self._record_start is not None:
+            self.record_queries.append(self.queries - self._record_start)
+            self._record_start = None
+
+    def downloaded(self, downloaded_file):
+        self.files_downloaded += 1
+        self.bytes_downloaded += downloaded_file.size
+
+    def _count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        self.stage_queries[self._stack[-1][0] if self._stack else 'other'] += 1
+        return execute(sql, params, many, context)
+
+    def as_dict(self):
+        per_record = self.record_queries or [0]
+        return {
+            'records': self.records,
+            'total_seconds': self.total,
+            'records_per_second': self.records / self.total if self.total else 0,
+            'queries': self.queries,
+            'queries_per_record': {'avg': sum(per_record) / len(per_record), 'max': max(per_record)},
+            'bytes_downloaded': self.bytes_downloaded,
+            'files_downloaded': self.files_downloaded,
+            'stages': {
+                name: {'seconds': seconds, 'calls': self.stage_calls[name], 'queries': self.stage_queries[name]}
+                for name, seconds in sorted(self.stages.items(), key=lambda item: -item[1])
+            },
+        }
+
+    def report(self, stdout, json_path=None):
+        data = self.as_dict()
+        other = data['total_seconds'] - sum(stage['seconds'] for stage in data['stages'].values())
+        stdout.write(f"{'stage':<16}{'seconds':>10}{'%':>7}{'calls':>9}{'queries':>9}")
+        for name, stage in data['stages'].items():
+            stdout.write(
+                f"{name:<16}{stage['seconds']:>10.2f}{100 * stage['seconds'] / max(self.total, 1e-9):>7.1f}"
+                f"{stage['calls']:>9}{stage['queries']:>9}"
+            )
+        stdout.write(f"{'other':<16}{other:>10.2f}{100 * other / max(self.total, 1e-9):>7.1f}{'':>9}{self.stage_queries['other']:>9}")
+        stdout.write(
+            f"{data['records']} records in {data['total_seconds']:.1f}s ({data['records_per_second']:.1f}/s), "
+            f"{data['queries']} queries ({data['queries_per_record']['avg']:.1f}/record, max {data['queries_per_record']['max']}), "
+            f"{data['files_downloaded']} files / {data['bytes_downloaded'] / 1024 / 1024:.1f} MB downloaded"
+        )
+        if json_path:
+            with open(json_path, 'w') as f:
+                json.dump(data, f, indent=2)
+
+
+def stage(name):
+    """ Times a command method as a stage, the command needs a self.metrics """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.stage(name):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
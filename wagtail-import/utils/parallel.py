@@ -0,0 +1,133 @@
+import multiprocessing
+import re
+import urllib.error
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from html import escape
+
+from django.core.files.storage import default_storage
+from django.db import connections
+from wagtail.images.models import Image
+
+from .asset_cache import AssetCache
+from .downloader import AssetDownloader
+from .html_pipeline import RewriteImages
+from .storage import upload_name
+
+# html is {source html: HtmlPipeline}, image rewrites in those pipelines get deferred to the writer.
+# assets is [(model, url)] for files that aren't in the html (cover image, paper pdf)
+PrepareJob = namedtuple('PrepareJob', ['content', 'html', 'assets'])
+# html is {source html: (rewritten html, [image urls])}, downloads is {url: DownloadedFile or DownloadFailed}
+PreparedRecord = namedtuple('PreparedRecord', ['html', 'downloads'])
+# Exceptions like HTTPError don't survive pickling back from the worker
+DownloadFailed = namedtuple('DownloadFailed', ['url', 'code', 'message'])
+
+_worker = {}
+
+
+class Placeholders:
+    """ Stands in for RewriteImages' resolve() in a worker, which can't save Images.
+    Each src becomes a token that fill_placeholders() swaps for the real url in the writer
+    """
+    token = '__import_asset_{}__'
+    pattern = re.compile(r'<img\b[^>]*?__import_asset_(\d+)__[^>]*>')
+
+    def __init__(self):
+        self.urls = []
+
+    def __call__(self, src):
+        self.urls.append(src)
+        return self.token.format(len(self.urls) - 1)
+
+
+def fill_placeholders(html, urls, resolve):
+    """ resolve(url) returns the saved image's url, or None to drop the <img> like RewriteImages does """
+    def replace(match):
+        n = int(match.group(1))
+        new_src = resolve(urls[n])
+        if not new_src:
+            return ''
+        return match.group(0).replace(Placeholders.token.format(n), escape(new_src))
+    return Placeholders.pattern.sub(replace, html)
+
+
+def as_exception(failed):
+    if failed.code:
+        return urllib.error.HTTPError(failed.url, failed.code, failed.message, None, None)
+    return OSError(failed.message)
+
+
+def make_pool(workers, download_workers, asset_cache_path, refresh_assets):
+    """ Process pool for prepare_record. Forks so workers share the already set up django,
+    the parent's db connections are closed first so no child ever uses a forked socket
+    """
+    connections.close_all()
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=_init_worker,
+        initargs=(download_workers, asset_cache_path, refresh_assets),
+    )
+
+
+def _init_worker(download_workers, asset_cache_path, refresh_assets):
+    # Workers stream files straight into storage too, the writer only saves the Image/Document rows
+    _worker['downloader'] = AssetDownloader(workers=download_workers, storage=default_storage, upload_to=upload_name)
+    # Only read from, the writer is the one adding to it
+    _worker['cache'] = None if refresh_assets else AssetCache(asset_cache_path)
+
+
+def prepare_record(job):
+    """ Runs in a worker: parse + rewrite the html and download everything the record needs.
+    Never touches the database
+    """
+    downloader, cache = _worker['downloader'], _worker['cache']
+    html = {}
+    assets = list(job.assets)
+    for source, pipeline in job.html.items():
+        placeholders = Placeholders()
+        for transform in pipeline.transforms:
+            if isinstance(transform, RewriteImages):
+                transform.resolve = placeholders
+        html[source] = (pipeline.run(source).html, placeholders.urls)
+        assets.extend((Image, url) for url in placeholders.urls)
+
+    urls = [url for model, url in assets if url and (cache is None or not cache.has_url(model, url))]
+    downloader.prefetch(urls)
+    downloads = {}
+    for url in urls:
+        try:
+            downloads[url] = downloader.fetch(url)
+        except urllib.error.HTTPError as e:
+            downloads[url] = DownloadFailed(url, e.code, str(e.reason))
+        except Exception as e:
+            downloads[url] = DownloadFailed(url, None, repr(e))
+        # Stored file is left for the writer, it removes it if it turns out to be a duplicate
+        downloader.discard(url, delete=False)
+    return PreparedRecord(html, downloads)
+
+
+def ordered_imap(executor, fn, iterable, lookahead):
+    """ Like executor.map but only keeps `lookahead` items in flight, so a streamed export isn't
+    read all at once. Yields (item, result) in the order items came in
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append((item, executor.submit(fn, item)))
+        if len(pending) >= lookahead:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def adopt_downloads(downloader, prepared, previous=()):
+    """ Gives the writer's downloader the files a worker fetched for this record. Drops whatever was left
+    over from the previous record (already in the asset cache by the time it was needed)
+    """
+    for url in previous:
+        downloader.discard(url)
+    for url, downloaded in prepared.downloads.items():
+        downloader.adopt(url, as_exception(downloaded) if isinstance(downloaded, DownloadFailed) else downloaded)
+    return list(prepared.downloads)
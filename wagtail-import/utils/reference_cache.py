@@ -0,0 +1,63 @@
+from django.db import transaction
+from django.utils.text import slugify
+
+
+class ReferenceCache:
+    """ Identity map for the reference data every imported page points at (classifier terms, collections,
+    index pages, tags). Each model is loaded once with one query and looked up from memory after that,
+    instead of a filter()/get() per page. Tags that don't exist yet are created with one bulk insert
+    for however many names are asked for at once.
+    Use the shared `references` instance so commands run in the same process (call_command) share it too
+    """
+
+    def __init__(self):
+        self._maps = {}
+        self._tags = {}
+
+    def clear(self):
+        self._maps.clear()
+        self._tags.clear()
+
+    def all(self, model, field='name'):
+        """ {value of field: [objects]} for every row of the model """
+        key = (model, field)
+        if key not in self._maps:
+            rows = self._maps[key] = {}
+            for obj in model.objects.all():
+                rows.setdefault(getattr(obj, field), []).append(obj)
+        return self._maps[key]
+
+    def filter(self, model, value, field='name'):
+        return self.all(model, field).get(value, [])
+
+    def get(self, model, value, field='name'):
+        """ Like model.objects.get(field=value) but returns None when there's no match """
+        matches = self.filter(model, value, field)
+        return matches[0] if matches else None
+
+    def first(self, model):
+        """ Like model.objects.first(), for index pages there's only one of """
+        return next((obj for objs in self.all(model, 'pk').values() for obj in objs), None)
+
+    def tags(self, tag_model, names):
+        """ Tag objects for the names, creating the missing ones in bulk.
+        Tags looked up or created inside a transaction are only remembered once it commits, so a page or batch
+        that rolls back doesn't leave tags in the cache that aren't in the database
+        """
+        names = set(names)
+        missing = names - self._tags.keys()
+        found = {}
+        if missing:
+            found.update((tag.name, tag) for tag in tag_model.objects.filter(name__in=missing))
+            new = [tag_model(name=name, slug=slugify(name)) for name in missing if name not in found]
+            if new:
+                tag_model.objects.bulk_create(new, ignore_conflicts=True)
+                found.update((tag.name, tag) for tag in tag_model.objects.filter(name__in=missing))
+                for name in missing - found.keys():
+                    # Slug clashed with a differently-named tag, let taggit pick a unique slug
+                    found[name], _ = tag_model.objects.get_or_create(name=name)
+            # Runs straight away outside a transaction
+            transaction.on_commit(lambda: self._tags.update(found))
+        return [self._tags.get(name) or found[name] for name in names]
+
+references = ReferenceCache()
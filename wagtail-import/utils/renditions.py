@@ -0,0 +1,80 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+from wagtail.images import get_image_model
+
+# Override with IMPORT_RENDITION_FILTERS in settings, use the specs the templates ask for
+DEFAULT_FILTER_SPECS = ['fill-300x200', 'fill-600x400', 'width-800', 'max-1200x1200']
+
+
+def filter_specs():
+    return getattr(settings, 'IMPORT_RENDITION_FILTERS', DEFAULT_FILTER_SPECS)
+
+
+def missing_renditions(image_ids, specs, chunk_size=500):
+    """ {image_id: [specs without a rendition yet]}, images that already have all of them are left out """
+    Image = get_image_model()
+    Rendition = Image.get_rendition_model()
+    image_ids = list(image_ids)
+    existing = set()
+    for i in range(0, len(image_ids), chunk_size):
+        existing.update(Rendition.objects.filter(
+            image_id__in=image_ids[i:i + chunk_size], filter_spec__in=specs
+        ).values_list('image_id', 'filter_spec'))
+    missing = {}
+    for image_id in image_ids:
+        todo = [spec for spec in specs if (image_id, spec) not in existing]
+        if todo:
+            missing[image_id] = todo
+    return missing
+
+
+def make_renditions(task):
+    """ Runs in a worker, each one opens its own db connection. Returns (image_id, made, errors) """
+    image_id, specs = task
+    try:
+        image = get_image_model().objects.get(pk=image_id)
+    except Exception as e:
+        return image_id, 0, [f'{e!r}']
+    made, errors = 0, []
+    for spec in specs:
+        try:
+            image.get_rendition(spec)
+            made += 1
+        except Exception as e:
+            # Missing or broken source file, one bad image shouldn't stop the rest
+            errors.append(f'{spec}: {e!r}')
+    return image_id, made, errors
+
+
+def warm_renditions(image_ids, specs=None, workers=None, stdout=None):
+    """ Generates the renditions pages will ask for so the first visitors don't wait on them.
+    Work is per image (the original is opened once for all its specs) across a forked process pool.
+    Returns (renditions made, renditions already there, images that failed)
+    """
+    specs = specs or filter_specs()
+    image_ids = list(dict.fromkeys(image_ids))
+    missing = missing_renditions(image_ids, specs)
+    skipped = len(image_ids) * len(specs) - sum(len(todo) for todo in missing.values())
+    made, failed = 0, []
+    if not missing:
+        return made, skipped, failed
+
+    workers = workers or multiprocessing.cpu_count()
+    # Same as the import pools, no worker inherits the parent's db connection
+    connections.close_all()
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    with pool:
+        tasks = list(missing.items())
+        results = pool.map(make_renditions, tasks, chunksize=max(1, len(tasks) // (workers * 4)))
+        for done, (image_id, count, errors) in enumerate(results, 1):
+            made += count
+            if errors:
+                failed.append(image_id)
+                if stdout:
+                    stdout.write(f'Rendition failed for image {image_id}: {", ".join(errors)}')
+            if stdout and done % 100 == 0:
+                stdout.write(f'{done}/{len(tasks)} images warmed')
+    return made, skipped, failed
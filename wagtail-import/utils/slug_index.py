@@ -0,0 +1,34 @@
+from django.core import exceptions
+from django.core.validators import validate_slug
+from django.utils.text import slugify
+
+
+class SlugIndex:
+    """ Slugs already used under the parent page, loaded once per import.
+    Wagtail only needs slugs to be unique between siblings, so instead of a query per page (or finding out
+    at add_child time) new pages claim a slug here. Clashes, with the site or earlier records in the same
+    export, get -2, -3... added in the order records come in, so reruns of the same export get the same slugs
+    """
+    max_length = 255
+
+    def __init__(self, parent):
+        self.taken = set(parent.get_children().values_list('slug', flat=True))
+
+    def claim(self, slug, title):
+        """ Returns a free slug, the old one if it's valid otherwise one made from the title """
+        try:
+            if not slug:
+                raise exceptions.ValidationError('No slug')
+            validate_slug(slug)
+        except exceptions.ValidationError:
+            print('Old slug invalid. New: ', slugify(title))
+            slug = slugify(title) or 'page'
+        slug = slug[:self.max_length]
+
+        candidate, n = slug, 1
+        while candidate in self.taken:
+            n += 1
+            suffix = f'-{n}'
+            candidate = slug[:self.max_length - len(suffix)] + suffix
+        self.taken.add(candidate)
+        return candidate
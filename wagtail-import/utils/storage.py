@@ -0,0 +1,63 @@
+import hashlib
+import io
+import mimetypes
+import uuid
+from urllib.parse import unquote, urlsplit
+
+from django.core.files import File
+from wagtail.documents import get_document_model
+from wagtail.images import get_image_model
+
+
+class HashingReader(File):
+    """ Wraps a download response for storage.save(). The storage pulls it in chunks straight off the
+    socket while sha1 and size are worked out, so the file is never held in memory or written to a temp file
+    """
+
+    def __init__(self, resp, name=None):
+        super().__init__(resp, name)
+        self.sha1 = hashlib.sha1()
+        self.bytes_read = 0
+        length = resp.headers.get('Content-Length')
+        if length and length.isdigit():
+            self.size = int(length)
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.sha1.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # Storages rewind before reading, that's fine as long as nothing was read yet
+        if offset == 0 and whence == io.SEEK_SET and not self.bytes_read:
+            return 0
+        raise io.UnsupportedOperation('seek')
+
+    def tell(self):
+        return self.bytes_read
+
+
+def file_name(url):
+    # Long ones are data: uris inlined in old bodies
+    if len(url) > 500:
+        return f'old_img_{str(uuid.uuid4().hex.upper()[0:6])}.jpg'
+    return unquote(urlsplit(url).path.rsplit('/', 1)[-1]) or f'old_file_{uuid.uuid4().hex[0:6]}'
+
+
+def upload_name(url, content_type):
+    """ Storage name the file would get if it was uploaded to an Image (images) or a Document (anything else) """
+    name = file_name(url)
+    guessed = mimetypes.guess_type(name)[0] or ''
+    is_image = content_type.startswith('image/') or guessed.startswith('image/')
+    model = get_image_model() if is_image else get_document_model()
+    return model._meta.get_field('file').generate_filename(model(), name)
+
+
+def stored_asset(model, downloaded, **fields):
+    """ Image/Document for a file the downloader already streamed into storage, nothing is copied again """
+    asset = model(file=downloaded.path, **fields)
+    for field, value in (('file_size', downloaded.size), ('file_hash', downloaded.sha1)):
+        if hasattr(asset, field):
+            setattr(asset, field, value)
+    return asset